@@ -2,13 +2,35 @@
 Defines the Agent class and its inheritors (SoloAgent, AskAgent)
 """
 
+import numpy as np
 from copy import deepcopy
 from query import Count, Product, Query
-from util import only_given_keys, permutations, hellinger_dist
+from util import only_given_keys, permutations, hellinger_dist, Encoder
 from causal_tools.enums import ASR
+from causal_tools.counts import CountStore, SparseCountTensor
 from math import inf
-import pgmpy 
-from pgmpy.factors.discrete import TabularCPD
+
+
+def thompson_draw(rng, alpha, rew_vals):
+  """
+  Draws one expected reward per arm from the Beta (binary reward) or
+  Dirichlet (categorical reward) posteriors with parameters alpha, an
+  array of shape (..., arms, rewards), in a single call for every arm
+  (and every world, when given leading batch dimensions).
+  """
+  if alpha.shape[-1] == 2:
+    p = rng.beta(alpha[..., 1], alpha[..., 0])
+    return rew_vals[0] + (rew_vals[1] - rew_vals[0]) * p
+  gammas = rng.standard_gamma(alpha)
+  return (gammas / gammas.sum(axis=-1, keepdims=True)) @ rew_vals
+
+
+def argmax_random(rng, values):
+  """
+  Argmax over the last axis of values, breaking ties at random.
+  """
+  best = values == values.max(axis=-1, keepdims=True)
+  return np.argmax(np.where(best, rng.random(values.shape), -1), axis=-1)
 
 
 class Agent:
@@ -23,42 +45,69 @@ class Agent:
     self.actions = permutations(only_given_keys(self.domains, [self.act_var]))
     self.rew_var = environment.rew_var
     self.rew_dom = self.domains[self.rew_var]
+    self.rew_vals = np.array(self.rew_dom, dtype=float)
     self.rewards = permutations(only_given_keys(self.domains, [self.rew_var]))
-    self.contexts = permutations(self.get_context())
+    self.ctx_enc = environment.ctx_enc
+    self.act_enc = environment.act_enc
     self.tau = tau
     self.asr_combo = asr
     self.asr = asr
-    self.epsilon = ([1] * len(self.contexts)
-                    if self.contexts else 1) if asr == ASR.ED else epsilon
+    # per-context exploration state, keyed by ctx_enc code once a context is seen
+    self.epsilon = {} if asr == ASR.ED else epsilon
     self.rand_trials = rand_trials
-    self.rand_trials_rem = [rand_trials] * \
-        len(self.contexts) if self.contexts else rand_trials
+    self.rand_trials_rem = {}
     self.cooling_rate = cooling_rate
 
-    # parents = environment.bn.model.get_parents(self.act_var)
-    # parents = {self.act_var} # Axel's original code
-    # for var in self.bn.get_ancestors(self.act_var): # this was cgm
-    #   if not self.bn.is_d_separated(var, self.rew_var, self.act_var): # this was cgm
-    #     parents.add(var)
-    # self.my_cpts["rew"] = CPT(self.rew_var, parents, self.domains)
-    parents = self.bn.get_parents(self.rew_var)
-    for var in self.bn.get_ancestors(self.act_var): 
-      if not self.bn.is_d_separated(var, self.rew_var, self.act_var):
-        parents.add(var)
-    # table = {key: 0 for key in Count(self.rew_var, parents).unassigned_combos(self.domains)}
-    # print(table)
-    # for item in table.items():
-    #   print(str(item[0]))
-    # table = []
-    # for i in range(len(self.domains)):
-    #   table.append([])
-    #   for j in range(len(self.domains)**len(parents)):
-    #     table[i].append(0)
-    table = [[0,0,0,0,0,0,0,0],
-             [0,0,0,0,0,0,0,0],
-             [0,0,0,0,0,0,0,0],
-             [0,0,0,0,0,0,0,0]] # TODO
-    self.reward_cpt = TabularCPD(self.rew_var, len(self.domains), table, parents, [2 for _ in range(len(parents))])
+    self.rew_parents = self.get_rew_parents()
+    self.counts = CountStore(
+        self.domains, {var: self.bn.get_parents(var) for var in self.domains})
+    self.rew_counts = self.counts.add_family(self.rew_var, self.rew_parents)
+    # the greedy policy, keyed by the encoded values of the reward parents
+    # besides the action: (expected reward of each action, best actions)
+    self.policy_enc = Encoder(self.domains, self.rew_parents - {self.act_var})
+    self.policy = {}
+
+  @property
+  def reward_cpt(self):
+    """
+    The reward model as a pgmpy TabularCPD of P(rew_var | rew_parents),
+    estimated from the counts (uniform where a parent configuration was never
+    observed). Its cardinalities come from the domains and its evidence is the
+    parent set in sorted order. Built (and pgmpy imported) only when asked for.
+    Raises ValueError when the reward family is counted sparsely, as its dense
+    table would exceed the CountStore's budget; reward_rows holds the model of
+    the observed parent configurations instead.
+    """
+    tensor = self.rew_counts
+    if isinstance(tensor, SparseCountTensor):
+      raise ValueError(
+          "The reward model of %s has %d parent configurations, too many for a dense CPD; "
+          "use reward_rows instead." % (self.rew_var, tensor.size // len(self.rew_dom)))
+    from pgmpy.factors.discrete import TabularCPD
+    counts = tensor.marginal(tensor.index({}), range(len(tensor.vars)))
+    counts = counts.reshape(len(self.rew_dom), -1)
+    totals = counts.sum(axis=0)
+    table = np.divide(counts, totals, out=np.full(counts.shape, 1 / len(self.rew_dom)),
+                      where=totals > 0)
+    return TabularCPD(self.rew_var, len(self.rew_dom), table, list(tensor.parents),
+                      [len(dom) for dom in tensor.domains[1:]],
+                      state_names={var: list(dom) for var, dom in zip(tensor.vars, tensor.domains)})
+
+  @property
+  def reward_rows(self):
+    """
+    The reward model estimated from the counts of the observed parent
+    configurations only, on either count backend: a dictionary from each
+    configuration (the parents' values, in sorted parent order) to the
+    probabilities of the reward values.
+    """
+    tensor = self.rew_counts
+    coords, cells = tensor.observed()
+    rows = {}
+    for coord, count in zip(coords.tolist(), cells.tolist()):
+      config = tuple(dom[i] for dom, i in zip(tensor.domains[1:], coord[1:]))
+      rows.setdefault(config, np.zeros(len(self.rew_dom)))[coord[0]] += count
+    return {config: row / row.sum() for config, row in rows.items()}
 
   def update_divergence(self):
     return
@@ -92,28 +141,20 @@ class Agent:
     return self.choose_optimal(givens)
 
   def epsilon_first(self, givens):
-    if self.contexts:
-      given_i = self.contexts.index(givens)
-      if self.rand_trials_rem[given_i] > 0:
-        self.rand_trials_rem[given_i] -= 1
-        return self.choose_random()
-    elif self.rand_trials_rem > 0:
-      self.rand_trials_rem -= 1
+    given_i = self.ctx_enc.encode(givens)
+    remaining = self.rand_trials_rem.get(given_i, self.rand_trials)
+    if remaining > 0:
+      self.rand_trials_rem[given_i] = remaining - 1
       return self.choose_random()
     return self.choose_optimal(givens)
 
   def epsilon_decreasing(self, givens):
-    if self.contexts:
-      given_i = self.contexts.index(givens)
-      if self.rng.random() < self.epsilon[given_i]:
-        self.epsilon[given_i] *= self.cooling_rate
-        return self.choose_random()
-      self.epsilon[given_i] *= self.cooling_rate
-      return self.choose_optimal(givens)
-    elif self.rng.random() < self.epsilon:
-      self.epsilon *= self.cooling_rate
+    given_i = self.ctx_enc.encode(givens)
+    epsilon = self.epsilon.get(given_i, 1)
+    explore = self.rng.random() < epsilon
+    self.epsilon[given_i] = epsilon * self.cooling_rate
+    if explore:
       return self.choose_random()
-    self.epsilon *= self.cooling_rate
     return self.choose_optimal(givens)
 
   def choose(self, givens):
@@ -138,18 +179,36 @@ class Agent:
     The behavior of the agent returning
     """
     self.recent = sample
-    for cpt in self.bn.model.get_cpds().values():
-      cpt.add(sample)
+    self.counts.observe(sample)
+    # only the reward estimates of the sample's parent configuration changed
+    self.policy.pop(self.policy_enc.encode(sample), None)
+
+  def observe_many(self, samples):
+    """
+    Observes a batch of samples given as a dictionary
+    of variables to arrays of their values.
+    """
+    self.recent = {var: int(values[-1]) for var, values in samples.items()}
+    self.counts.observe_many(samples)
+    for key in np.unique(self.policy_enc.encode_batch(samples)).tolist():
+      self.policy.pop(key, None)
 
   def get_recent(self):
     return self.recent
 
-  def get_rew_query_unfactored(self):
+  def get_rew_parents(self):
+    """
+    The variables the reward model conditions on: the action and its
+    ancestors that aren't d-separated from the reward given the action.
+    """
     parents = {self.act_var}
     for var in self.bn.get_ancestors(self.act_var): # this was cgm
       if not self.bn.is_d_separated(var, self.rew_var, self.act_var): # this was cgm
         parents.add(var)
-    return Query(self.rew_var, parents)
+    return parents
+
+  def get_rew_query_unfactored(self):
+    return Query(self.rew_var, self.rew_parents)
 
   def expected_rew(self, givens, cpts):
     summ = 0
@@ -158,24 +217,48 @@ class Agent:
     for rew in self.rewards:
       query.assign(rew)
       # print(cpts)
-      rew_prob = query.solve(self.reward_cpt)
+      rew_prob = query.solve(cpts)
       summ += rew[self.rew_var] * rew_prob if rew_prob is not None else 0
     return summ
 
   def choose_optimal(self, context):
-    cpts = self.bn.model.get_cpds()
-    best_acts = []
-    best_rew = -inf
-    for act in self.actions:
-      expected_rew = self.expected_rew({**context, **act}, cpts)
-      if expected_rew is not None:
-        if expected_rew > best_rew:
-          best_acts = [act]
-          best_rew = expected_rew
-        elif expected_rew == best_rew:
-          best_acts.append(act)
-    # assert bool(best_acts)
-    return self.rng.choice(best_acts)
+    """
+    Chooses at random among the actions of highest expected reward in the
+    context. When the context assigns every reward parent, these come from
+    the policy table, recomputed only after an observation changed them.
+    """
+    key = self.policy_key(context)
+    entry = self.policy.get(key) if key is not None else None
+    if entry is None:
+      expected = self.expected_rews(context)
+      best = [self.actions[i] for i in np.flatnonzero(expected == expected.max())]
+      entry = (expected, best)
+      if key is not None:
+        self.policy[key] = entry
+    best = entry[1]
+    return best[self.rng.integers(len(best))]
+
+  def policy_key(self, context):
+    if not all(var in context for var in self.policy_enc.vars):
+      return None
+    return self.policy_enc.encode(context)
+
+  def expected_rews(self, context):
+    """
+    Returns the expected reward of every action given the reward parents
+    assigned by context (0 for actions never observed there), as
+    expected_rew computes them one at a time.
+    """
+    tensor = self.rew_counts
+    counts = tensor.marginal(
+        tensor.index(only_given_keys(context, self.policy_enc.vars)),
+        (tensor.axes[self.act_var], tensor.axes[self.rew_var]))
+    totals = counts.sum(axis=1)
+    probs = np.divide(counts, totals[:, None], out=np.zeros(counts.shape), where=totals[:, None] > 0)
+    expected = np.zeros(len(self.actions))
+    for j, rew in enumerate(self.rew_dom):
+      expected += rew * probs[:, j]
+    return expected
 
   def choose_random(self):
     """
@@ -183,24 +266,24 @@ class Agent:
     """
     return self.rng.choice(self.actions)
 
+  def reward_counts(self, context):
+    """
+    Returns the reward counts in the given context as an
+    (actions, rewards) array, summing out any other parents.
+    """
+    tensor = self.rew_counts
+    return tensor.marginal(
+        tensor.index(only_given_keys(context, tensor.vars)),
+        (tensor.axes[self.act_var], tensor.axes[self.rew_var]))
+
   def thompson_sample(self, context):
-    best_acts = []
-    best_sample = 0
-    cpts = self.get_cpts()
-    rew_query = self.get_rew_query_unfactored()
-    rew_query = Count(rew_query)
-    rew_query.assign(context)
-    for act in self.actions:
-      rew_query.assign(act)
-      alpha = cpts["rew"][rew_query.assign({self.rew_var: 1})]
-      beta = cpts["rew"][rew_query.assign({self.rew_var: 0})]
-      sample = self.rng.beta(alpha + 1, beta + 1)
-      if sample > best_sample:
-        best_sample = sample
-        best_acts = [act]
-      if sample == best_sample:
-        best_acts.append(act)
-    return self.rng.choice(best_acts)
+    """
+    Draws every arm from its Beta/Dirichlet reward posterior at once
+    and chooses the best draw.
+    """
+    alpha = self.reward_counts(context) + 1
+    samples = thompson_draw(self.rng, alpha, self.rew_vals)
+    return self.actions[argmax_random(self.rng, samples)]
 
   def get_otp(self):
     return self.__class__.__name__[:-5]
@@ -220,9 +303,6 @@ class SoloAgent(Agent):
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
 
-  def get_cpts(self):
-    return self.bn.model.get_cpts()
-
 
 class AskAgent(Agent):
   def __init__(self, bn, *args, **kwargs):
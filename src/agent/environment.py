@@ -8,11 +8,27 @@ The code has been imported and modified into this project for ease/consistency
 """
 
 
-import pandas as pd
-from util import hash_from_dict, only_given_keys, permutations
-from math import inf
-from causal_tools.assignment_models import ActionModel
-from causal_tools.bn import BN
+import numpy as np
+from contextlib import contextmanager
+from util import only_given_keys, permutations, Encoder
+from causal_tools.assignment_models import ActionModel, DiscreteModel, random_rows, cumulative_table
+from causal_tools.bn import BN, CPDStructure
+from shared import SharedBlock
+
+# the arrays a frozen snapshot places in shared memory (besides the factors)
+SHARED_ARRAYS = ("reward_table", "optimal_reward", "optimal_action_mask")
+
+# the name of the leading axis of stacked factors, one entry per environment
+BATCH = None
+
+
+def optimal_tables(reward_table):
+    """
+    Returns the optimal reward of every context of a (..., context, action)
+    reward table and the mask of the actions that reach it.
+    """
+    optimal_reward = reward_table.max(axis=-1)
+    return optimal_reward, np.isclose(reward_table, optimal_reward[..., None])
 
 
 class Environment:
@@ -22,6 +38,7 @@ class Environment:
         { variable: Function(parents) }
         """
         self.cpds =cpds
+        self._blocks = None
         self.domains = {}
         self._assignment = assignment.copy()
         nodes = list(assignment.keys())
@@ -41,11 +58,9 @@ class Environment:
                 for parent in model.parents
             ])
 
-        # TODO: data is empty right now?
         # TODO: generate the data from the assignment
-        data = pd.DataFrame()
         self.bn = BN(nodes=nodes, edges=edges,
-                       data=data, set_nodes=set_nodes)
+                       data=None, set_nodes=set_nodes)
 
         pre_nodes = list(self.bn.get_ancestors(self.act_var))
         # print("+=========================+")
@@ -104,80 +119,208 @@ class Environment:
         return only_given_keys(self.domains, [self.rew_var])
 
     def assigned_optimal_actions(self):
-        if self.has_context():
-            self.optimal_reward = {}
-            self.optimal_actions = {}
-            for feat_combo in permutations(self.get_feat_doms()):
-                best = self.get_optimal(feat_combo)
-                feat_hash = hash_from_dict(feat_combo)
-                self.optimal_reward[feat_hash] = best[0]
-                self.optimal_actions[feat_hash] = best[1]
-            return
-        best = self.get_optimal()
-        self.optimal_reward = best[0]
-        self.optimal_actions = best[1]
+        """
+        Computes the dense (context, action) table of E[rew_var | do(action), context]
+        and, from it, the optimal reward and optimal actions of every context.
+        Contexts and actions are numbered by self.ctx_enc and self.act_enc.
+        """
+        self.ctx_enc = Encoder(self.domains, self.feat_vars)
+        self.act_enc = Encoder(self.domains, [self.act_var])
+        self.actions = permutations(self.get_act_dom())
+        self.factors = self.compile_factors()
+        reward_table = self.expected_reward_table()
+        self.set_reward_table(reward_table, *optimal_tables(reward_table))
+
+    def set_reward_table(self, reward_table, optimal_reward, optimal_action_mask):
+        self.reward_table = reward_table
+        self.optimal_reward = optimal_reward
+        self.optimal_action_mask = optimal_action_mask
+        self.optimal_actions = [
+            [self.actions[i] for i in np.flatnonzero(row)] for row in optimal_action_mask]
+
+    def compile_factors(self):
+        """
+        Compiles every non-action node's model into a NumPy factor of shape
+        (parent domains..., node domain), returned with the variables of its axes.
+        """
+        factors = {}
+        for node, model in self._assignment.items():
+            if isinstance(model, ActionModel):
+                continue
+            factors[node] = (self.compile_factor(model, model._table), tuple(model.parents) + (node,))
+        return factors
+
+    def compile_factor(self, model, table):
+        """
+        Reshapes a dense table of model (optionally stacked along leading axes)
+        into a factor over the full parent domains, zeroing rows without a lookup.
+        The table is indexed by the positions of parent values among the model's
+        lookup values and the factor by their positions in the domains, so each
+        row is scattered from one to the other.
+        """
+        lead = table.shape[:table.ndim - model._table.ndim]
+        width = len(model.domain)
+        table = table.reshape(lead + model._radix + (width,))
+        if isinstance(model, DiscreteModel):
+            table = table * model._valid.reshape(model._radix + (1,))
+        rows, positions = [], []
+        for parent, lookup in zip(model.parents, model._positions):
+            values = [val for val in self.domains[parent] if val in lookup]
+            rows.append([lookup[val] for val in values])
+            positions.append([self.domains[parent].index(val) for val in values])
+        factor = np.zeros(lead + tuple(len(self.domains[p]) for p in model.parents) + (width,))
+        outputs = range(width)
+        factor[(Ellipsis,) + np.ix_(*positions, outputs)] = table[(Ellipsis,) + np.ix_(*rows, outputs)]
+        return factor
+
+    def expected_reward_table(self, factors=None, batch=False):
+        """
+        Contracts the factors of the ancestors of the reward and context variables
+        (with the action variable left free, i.e. intervened on) into the joint
+        P(context, rew_var | do(action)) in a single einsum, then takes the
+        expected reward of each (context, action).
+
+        With batch, the factors are stacked along a leading BATCH axis and one
+        table per entry is returned, shape (batch, context, action).
+        """
+        factors = self.factors if factors is None else factors
+        relevant = self.bn.get_ancestors([self.rew_var] + self.ctx_enc.vars)
+        # einsum labels must be small ints, so number only the variables involved
+        labels = {var: i for i, var in enumerate(sorted(relevant))}
+        labels[BATCH] = len(labels)
+        operands = [np.ones(len(self.domains[self.act_var])), [labels[self.act_var]]]
+        for node in relevant:
+            if node in factors:
+                factor, axes = factors[node]
+                operands.extend([factor, [labels[var] for var in axes]])
+        out_vars = ([BATCH] if batch else []) + self.ctx_enc.vars + [self.act_var, self.rew_var]
+        out = [labels[var] for var in out_vars]
+        joint = np.einsum(*operands, out, optimize='greedy')
+        lead = joint.shape[:1] if batch else ()
+        joint = joint.reshape(lead + (-1, len(self.actions), len(self.domains[self.rew_var])))
+        totals = joint.sum(axis=-1)
+        summ = joint @ np.array(self.domains[self.rew_var], dtype=float)
+        return np.divide(summ, totals, out=np.zeros_like(summ), where=totals > 0)
+
+    def randomize(self, rng, n, nmc):
+        """
+        Returns n randomized environments with the structure of this one. In the
+        first, every lookup row of every non-action node is redrawn uniformly from
+        the simplex; each of the others redraws each node again with probability
+        nmc and otherwise keeps the first's. All rows are drawn in bulk and the
+        reward tables of all n are contracted at once; the environments share
+        this one's graphs and sampling plans.
+        """
+        nodes = [node for node, model in self._assignment.items()
+                 if not isinstance(model, ActionModel)]
+        mutated = rng.random((n, len(nodes))) < nmc
+        mutated[0] = True
+        tables, cdfs, factors = {}, {}, {}
+        for j, node in enumerate(nodes):
+            model = self._assignment[node]
+            width = model._table.shape[-1]
+            table = random_rows(rng, (n,) + model._table.shape[:-1], width)
+            table[~mutated[:, j]] = table[0]
+            if isinstance(model, DiscreteModel):
+                table[:, ~model._valid] = 1 / width
+            tables[node] = table
+            cdfs[node] = cumulative_table(table)
+            factors[node] = (self.compile_factor(model, table), (BATCH,) + tuple(model.parents) + (node,))
+        reward_tables = self.expected_reward_table(factors, batch=True)
+        optimal_reward, optimal_action_mask = optimal_tables(reward_tables)
+        return [self.with_models(
+            {node: self._assignment[node].with_table(tables[node][k], cdfs[node][k]) for node in nodes},
+            {node: (factor[k], axes[1:]) for node, (factor, axes) in factors.items()},
+            reward_tables[k], optimal_reward[k], optimal_action_mask[k]) for k in range(n)]
+
+    def with_models(self, models, factors, reward_table, optimal_reward, optimal_action_mask):
+        """
+        Returns an environment sharing the structure of this one whose models,
+        factors and reward tables are replaced by those given.
+        """
+        env = self.__class__.__new__(self.__class__)
+        env.__dict__.update(self.__dict__)
+        env._assignment = dict(self._assignment, **models)
+        env.pre = self.pre.with_models(models)
+        env.post = self.post.with_models(models)
+        env.factors = dict(self.factors, **factors)
+        env._blocks = None
+        env.set_reward_table(reward_table, optimal_reward, optimal_action_mask)
+        return env
 
     def get_optimal(self, givens={}):
-        best_actions = list()
-        best_rew = -inf
-        for action in permutations(self.get_act_dom()):
-            expected_rew = self.expected_reward({**action, **givens})
-            if expected_rew > best_rew:
-                best_actions = [action]
-                best_rew = expected_rew
-            elif expected_rew == best_rew:
-                best_actions.append(action)
-        return (best_rew, best_actions)
-
-    def assign_dist_with_givens(self, dist, givens):
-        for var, parents in dist.items():
-            if var in givens:
-                dist[var] = givens[var]
-            elif isinstance(parents, dict):
-                self.assign_dist_with_givens(parents, givens)
-        return dist
-
-    def parse_dist_as_probs(self, assigned_dist):
-        for var, assignment in assigned_dist.items():
-            if isinstance(assignment, dict):
-                assigned_dist[var] = self.parse_dist_as_probs(assignment)
-            assigned_dist[var] = self._assignment[var].prob(assignment)
-        return assigned_dist
+        ctx = self.ctx_enc.encode(givens)
+        return (self.optimal_reward[ctx], self.optimal_actions[ctx])
 
     def expected_reward(self, givens={}):
-        assigned_dist = self.assign_dist_with_givens(
-            self.bn.get_dist_as_dict(self.rew_var), givens)
-        reward_value_probs = self._assignment[self.rew_var].prob(
-            self.parse_dist_as_probs(assigned_dist[self.rew_var]))
-        return self.expected_value(reward_value_probs)
-
-    def expected_value(self, value_probs):
-        expected_value = 0
-        for value, prob in value_probs.items():
-            expected_value += value * prob
-        return expected_value
+        return self.reward_table[self.ctx_enc.encode(givens), self.act_enc.encode(givens)]
 
     def get_optimal_reward(self, context):
-        if context:
-            return self.optimal_reward[hash_from_dict(context)]
-        return self.optimal_reward
+        return self.optimal_reward[self.ctx_enc.encode(context)]
 
     def get_optimal_actions(self, context):
-        if context:
-            return self.optimal_actions[hash_from_dict(context)]
-        return self.optimal_actions
+        return self.optimal_actions[self.ctx_enc.encode(context)]
+
+    @contextmanager
+    def shared(self):
+        """
+        While active, pickling this environment produces a frozen snapshot whose
+        factors and optimal reward/action tables are shared memory blocks, so
+        workers attach to it zero-copy instead of rebuilding it. The blocks are
+        freed on exit.
+        """
+        # compile the sampling plans so they are pickled with the snapshot
+        self.pre.get_sampling_plan()
+        self.post.get_sampling_plan()
+        blocks = {name: SharedBlock(getattr(self, name)) for name in SHARED_ARRAYS}
+        for node, (factor, _) in self.factors.items():
+            blocks[("factors", node)] = SharedBlock(factor)
+        self._blocks = blocks
+        try:
+            yield self
+        finally:
+            self._blocks = None
+            for block in blocks.values():
+                block.unlink()
+
+    def snapshot(self):
+        ignored = SHARED_ARRAYS + ("factors", "cpds", "_blocks")
+        state = {key: val for key, val in self.__dict__.items() if key not in ignored}
+        state.update({name: self._blocks[name] for name in SHARED_ARRAYS})
+        state["factors"] = {node: (self._blocks[("factors", node)], axes)
+                            for node, (_, axes) in self.factors.items()}
+        state["cpds"] = [CPDStructure.of(cpd) for cpd in self.cpds]
+        return state
+
+    @classmethod
+    def from_snapshot(cls, state):
+        """
+        Rebuilds an environment from a snapshot, attaching its arrays.
+        """
+        env = cls.__new__(cls)
+        env.__dict__.update(state)
+        for name in SHARED_ARRAYS:
+            setattr(env, name, state[name].attach())
+        env.factors = {node: (block.attach(), axes)
+                       for node, (block, axes) in state["factors"].items()}
+        env._blocks = None
+        return env
 
     def __reduce__(self):
-        return (self.__class__, (self._assignment, self.rew_var))
+        if self._blocks is not None:
+            return (self.__class__.from_snapshot, (self.snapshot(),))
+        # only the structure of the cpds is needed to rebuild the graphs
+        structures = [CPDStructure.of(cpd) for cpd in self.cpds]
+        return (self.__class__, (self._assignment, self.rew_var, structures))
 
     def __repr__(self):
-        variables = ", ".join(map(str, sorted(self.bn.dag.nodes())))
+        variables = ", ".join(map(str, sorted(self.bn.nodes)))
         return ("{classname}({vars})"
                 .format(classname=self.__class__.__name__,
                         vars=variables))
 
     def __copy__(self):
-        return Environment(self._assignment, self.rew_var)
+        return Environment(self._assignment, self.rew_var, self.cpds)
 
     def __getitem__(self, key):
         return self._assignment[key]
@@ -2,24 +2,39 @@
 Defines the World class, which constitutes the environment agents interact in for a single
 simulation. All agents and their environments exist in a World, and this class is used to
 store results to be returned to the process and simulation at the end of execution.
+
+The BatchWorld class steps many Monte Carlo worlds in lockstep, holding the state of every
+world's agent in NumPy arrays so that each phase of an episode is one vectorized operation.
 """
 
-from util import only_given_keys
+import numpy as np
+from causal_tools.enums import ASR
+from agent.agent import thompson_draw, argmax_random
+from causal_tools.counts import DENSE_BUDGET
+from profiling import NO_CLOCK
 
 
 class World:
-  def __init__(self, agent, T):
+  def __init__(self, agent, T, profiler=None):
     self.agent = agent #this is the main model
     self.cpr = [0] * T
     self.poa = [0] * T
     self.daemons = set()
+    self.profiler = profiler
 
   def run_episode(self, ep): # this is one trial
+    clock = self.profiler.start(self.agent.asr) if self.profiler else NO_CLOCK
     context = self.agent._environment.pre.sample(self.agent.rng)
+    clock.lap()
     action = self.agent.choose(context)
-    sample = self.agent._environment.post.sample(self.agent.rng, {**context, **action})
+    clock.lap()
+    sample = self.agent._environment.post.sample(
+        self.agent.rng, set_values={**context, **action})
+    clock.lap()
     self.agent.observe(sample) # this may be where fit is called? not sure...
+    clock.lap()
     self.update(ep)
+    clock.lap()
     # self.check_for_questions()
     # new_info = self.run_daemons()
     #apply new info
@@ -27,15 +42,14 @@ class World:
 
   def update(self, ep):
     recent = self.agent.get_recent()
+    env = self.agent._environment
+    ctx = env.ctx_enc.encode(recent)
     rew_received = recent[self.agent.rew_var]
-    feature_assignments = only_given_keys(recent, self.agent._environment.feat_vars)
-    rew_optimal = self.agent._environment.get_optimal_reward(feature_assignments)
+    rew_optimal = env.optimal_reward[ctx]
     curr_regret = self.cpr[ep-1]
     new_regret = curr_regret + (rew_optimal - rew_received)
     self.cpr[ep] = new_regret
-    optimal_actions = self.agent._environment.get_optimal_actions(feature_assignments)
-    self.poa[ep] = 1 if only_given_keys(
-        recent, self.agent.act_var) in optimal_actions else 0
+    self.poa[ep] = int(env.optimal_action_mask[ctx, env.act_enc.encode(recent)])
     return
 
   def check_for_questions(self):
@@ -55,3 +69,132 @@ class World:
   def __reduce__(self):
     return (self.__class__, (self.agents, self.T))
 
+
+class Slots:
+  """
+  Maps the codes of an encoder of size codes to the rows of per-code state
+  arrays. When the state of every code fits in budget bytes (row_bytes per
+  code) the codes are the rows; otherwise rows are handed out as codes are
+  first seen, so the state grows with the configurations that occur.
+  """
+  def __init__(self, size, row_bytes, budget=DENSE_BUDGET):
+    self.dense = size * row_bytes <= budget
+    self.capacity = size if self.dense else 16
+    self.rows = {}
+
+  def __call__(self, codes):
+    if self.dense:
+      return codes
+    unique, inverse = np.unique(codes, return_inverse=True)
+    rows = np.array([self.rows.setdefault(code, len(self.rows)) for code in unique.tolist()])
+    return rows[inverse]
+
+  def fit(self, state, fill):
+    """
+    Returns state (an array with the rows along axis 1) grown with rows of
+    fill until it has one for every code seen.
+    """
+    if not isinstance(state, np.ndarray) or state.shape[1] >= len(self.rows):
+      return state
+    extra = max(state.shape[1], len(self.rows) - state.shape[1])
+    pad = np.full(state.shape[:1] + (extra,) + state.shape[2:], fill, dtype=state.dtype)
+    return np.concatenate([state, pad], axis=1)
+
+
+class BatchWorld:
+  """
+  Runs B independent copies of a World whose agents all share the assignment
+  of the given (template) agent. Each agent's knowledge is kept as reward
+  counts indexed by (world, key, action, reward), where key is the agent's
+  policy_enc code of the reward parents besides the action, which is what the
+  agent's reward query solves over. Contexts (the action's parents) key only
+  the per-context exploration state and the regret. Keys and contexts index
+  that state through Slots, so it is only held densely when it fits in budget.
+  """
+  def __init__(self, agent, T, B, profiler=None, budget=DENSE_BUDGET):
+    self.agent = agent
+    self.profiler = profiler
+    self.rng = agent.rng
+    self.B = B
+    self.rows = np.arange(B)
+    env = agent._environment
+    self.environment = env
+    self.act_var = agent.act_var
+    self.rew_var = agent.rew_var
+    self.act_vals = env.act_enc.values(self.act_var)
+    self.rew_vals = np.array(agent.rew_dom, dtype=float)
+    self.optimal_reward = env.optimal_reward
+    self.optimal_actions = env.optimal_action_mask
+    self.policy_enc = agent.policy_enc
+    n_ctx, n_act = self.optimal_actions.shape
+    n_rew = len(self.rew_vals)
+    self.key_slots = Slots(self.policy_enc.size, 8 * B * n_act * n_rew, budget)
+    self.ctx_slots = Slots(n_ctx, 8 * B, budget)
+    self.counts = np.zeros((B, self.key_slots.capacity, n_act, n_rew), dtype=int)
+    self.epsilon = np.ones((B, self.ctx_slots.capacity)) if agent.asr == ASR.ED else agent.epsilon
+    self.rand_trials_rem = np.full((B, self.ctx_slots.capacity), agent.rand_trials)
+    self.cpr = np.zeros((B, T))
+    self.poa = np.zeros((B, T), dtype=np.int8)
+
+  def run_episode(self, ep):
+    clock = self.profiler.start(self.agent.asr) if self.profiler else NO_CLOCK
+    pre = self.environment.pre.sample(self.rng, self.B)
+    ctx = self.environment.ctx_enc.encode_batch(pre) + np.zeros(self.B, dtype=int)
+    key = self.key_slots(self.policy_enc.encode_batch(pre) + np.zeros(self.B, dtype=int))
+    self.counts = self.key_slots.fit(self.counts, 0)
+    clock.lap()
+    act = self.choose(ctx, key)
+    clock.lap()
+    sample = self.environment.post.sample(
+        self.rng, self.B, {**pre, self.act_var: self.act_vals[act]})
+    rew = sample[self.rew_var]
+    clock.lap()
+    self.observe(key, act, rew)
+    clock.lap()
+    self.update(ep, ctx, act, rew)
+    clock.lap()
+    return
+
+  def choose(self, ctx, key):
+    asr = self.agent.asr
+    if asr == ASR.TS:
+      return self.thompson_sample(key)
+    if asr == ASR.EG:
+      explore = self.rng.random(self.B) < self.epsilon
+    elif asr == ASR.EF:
+      slot = self.ctx_slots(ctx)
+      self.rand_trials_rem = self.ctx_slots.fit(self.rand_trials_rem, self.agent.rand_trials)
+      explore = self.rand_trials_rem[self.rows, slot] > 0
+      self.rand_trials_rem[self.rows, slot] -= explore
+    elif asr == ASR.ED:
+      slot = self.ctx_slots(ctx)
+      self.epsilon = self.ctx_slots.fit(self.epsilon, 1)
+      explore = self.rng.random(self.B) < self.epsilon[self.rows, slot]
+      self.epsilon[self.rows, slot] *= self.agent.cooling_rate
+    else:
+      raise ValueError("%s ASR not found" % asr)
+    random = self.rng.integers(len(self.act_vals), size=self.B)
+    return np.where(explore, random, self.choose_optimal(key))
+
+  def expected_rew(self, key):
+    counts = self.counts[self.rows, key]
+    totals = counts.sum(axis=-1)
+    summ = counts @ self.rew_vals
+    return np.divide(summ, totals, out=np.zeros_like(summ), where=totals > 0)
+
+  def choose_optimal(self, key):
+    return argmax_random(self.rng, self.expected_rew(key))
+
+  def thompson_sample(self, key):
+    alpha = self.counts[self.rows, key] + 1
+    return argmax_random(self.rng, thompson_draw(self.rng, alpha, self.rew_vals))
+
+  def observe(self, key, act, rew):
+    self.counts[self.rows, key, act, rew] += 1
+
+  def update(self, ep, ctx, act, rew):
+    curr_regret = self.cpr[:, ep-1] if ep > 0 else 0
+    self.cpr[:, ep] = curr_regret + (self.optimal_reward[ctx] - self.rew_vals[rew])
+    self.poa[:, ep] = self.optimal_actions[ctx, act]
+    return
+
@@ -0,0 +1,225 @@
+"""
+Times the hot paths of a simulation (model sampling, BN sampling, d-separation,
+Environment construction, Agent.choose_optimal, World.run_episode and Process.simulate)
+on the 'big chain' causal structure X -> S1 -> ... -> SN -> Y, parameterized over the
+number of links, the cardinality of every domain and T.
+
+Run it from the command line. Results are written as JSON; passing --compare with a
+saved results file reports the change of every benchmark against it and exits non-zero
+when any benchmark is slower than the allowed tolerance. --imports adds a report of
+the import time of the modules a worker loads, in a fresh interpreter each.
+"""
+import argparse
+import os
+import platform
+import subprocess
+import sys
+import time
+from itertools import product
+from json import dump, load
+from numpy.random import default_rng
+from causal_tools.assignment_models import ActionModel, DiscreteModel
+from causal_tools.enums import ASR, OTP
+from agent.agent import SoloAgent
+from agent.environment import Environment
+from agent.world import World
+from process import Process
+
+DEFAULT_LINKS = (2, 8)
+DEFAULT_CARDINALITIES = (2, 4)
+DEFAULT_TS = (100,)
+
+
+def chain_environment_dict(links, cardinality, seed=0):
+    """
+    Returns the assignment of X -> S1 -> ... -> S<links> -> Y where X is the
+    action and every other node has a random conditional table.
+    """
+    rng = default_rng(seed)
+    domain = tuple(range(cardinality))
+    assignment = {"X": ActionModel(None, domain)}
+    parent = "X"
+    for node in ["S%d" % i for i in range(1, links + 1)] + ["Y"]:
+        assignment[node] = DiscreteModel(
+            (parent,), {(val,): tuple(rng.dirichlet([1] * cardinality)) for val in domain})
+        parent = node
+    return assignment
+
+
+def time_call(fn, min_time=0.2, max_calls=10000):
+    """
+    Calls fn repeatedly for at least min_time seconds (or max_calls calls)
+    and returns the mean and minimum seconds per call.
+    """
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_calls and time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - call_start)
+    return {"mean": sum(times) / len(times), "min": min(times), "calls": len(times)}
+
+
+def bench_model(env, rng, **kwargs):
+    model = env._assignment["Y"]
+    parents = {parent: env.domains[parent][0] for parent in model.parents}
+    return time_call(lambda: model.model(rng, **parents))
+
+
+def bench_bn_sample(env, rng, **kwargs):
+    set_values = {env.act_var: env.domains[env.act_var][0]}
+    return time_call(lambda: env.post.sample(rng, set_values=set_values))
+
+
+def bench_d_separation(env, rng, **kwargs):
+    bn = env.bn
+    nodes = list(env.domains)
+
+    def query():
+        # clear the memo so every call runs the search
+        bn.get_graph_index().d_connected.clear()
+        return bn.is_d_separated(nodes[0], nodes[-1], set(nodes[1:2]))
+    return time_call(query)
+
+
+def bench_environment(env, rng, links, cardinality, **kwargs):
+    assignment = chain_environment_dict(links, cardinality)
+    return time_call(lambda: Environment(assignment), max_calls=100)
+
+
+def bench_choose_optimal(env, rng, T, **kwargs):
+    agent = SoloAgent(rng, "SoloAgent", env, asr=ASR.EG)
+    world = World(agent, T)
+    for k in range(T):
+        world.run_episode(k)
+    return time_call(lambda: agent.choose_optimal({}))
+
+
+def bench_run_episode(env, rng, T, **kwargs):
+    def episodes():
+        world = World(SoloAgent(rng, "SoloAgent", env, asr=ASR.EG, epsilon=0.1), T)
+        for k in range(T):
+            world.run_episode(k)
+    return per_episode(time_call(episodes, max_calls=100), T)
+
+
+def bench_process(env, rng, T, batched=False, mc_sims=4, **kwargs):
+    def simulate():
+        Process(rng, env, env.rew_var, False, 0, None, mc_sims, T,
+                [{"otp": OTP.SOLO, "asr": ASR.EG, "epsilon": 0.1}], 1, False,
+                env.domains, env.act_var, batched=batched).simulate()
+    return time_call(simulate, max_calls=20)
+
+
+def bench_process_batched(env, rng, T, **kwargs):
+    return bench_process(env, rng, T, batched=True, mc_sims=256)
+
+
+def per_episode(timing, T):
+    return dict(timing, mean=timing["mean"] / T, min=timing["min"] / T)
+
+
+BENCHMARKS = {
+    "DiscreteModel.model": bench_model,
+    "BN.sample": bench_bn_sample,
+    "BN.is_d_separated": bench_d_separation,
+    "Environment": bench_environment,
+    "Agent.choose_optimal": bench_choose_optimal,
+    "World.run_episode": bench_run_episode,
+    "Process.simulate": bench_process,
+    "Process.simulate[batched]": bench_process_batched,
+}
+
+
+def run(links=DEFAULT_LINKS, cardinalities=DEFAULT_CARDINALITIES, Ts=DEFAULT_TS, only=None, seed=0):
+    results = []
+    for n, k, T in product(links, cardinalities, Ts):
+        env = Environment(chain_environment_dict(n, k, seed))
+        for name, bench in BENCHMARKS.items():
+            if only and not any(o in name for o in only):
+                continue
+            timing = bench(env, default_rng(seed), links=n, cardinality=k, T=T)
+            results.append({"name": name, "links": n, "cardinality": k, "T": T, **timing})
+            print("%-28s links=%-3d k=%-2d T=%-5d %12.2f us" % (name, n, k, T, timing["mean"] * 1e6))
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+# modules a headless worker should never import
+HEAVY_MODULES = ("pgmpy", "pandas", "plotly", "networkx", "graphviz", "torch", "sklearn")
+WORKER_MODULES = ("process", "executor", "sweep", "sim")
+
+
+def import_report(modules=WORKER_MODULES):
+    """
+    Imports each module in a fresh interpreter with -X importtime and returns
+    its cumulative import time and the heavy modules it pulled in.
+    """
+    report = {}
+    for module in modules:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        seconds, heavy = 0.0, set()
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            name = name.strip()
+            if name == module:
+                seconds = int(cumulative) / 1e6
+            if name.split(".")[0] in HEAVY_MODULES:
+                heavy.add(name.split(".")[0])
+        report[module] = {"seconds": seconds, "heavy": sorted(heavy)}
+        print("import %-10s %8.3f s  %s" % (module, seconds, ", ".join(sorted(heavy)) or "-"))
+    return report
+
+
+def benchmark_key(result):
+    return (result["name"], result["links"], result["cardinality"], result["T"])
+
+
+def compare(current, baseline, tolerance):
+    """
+    Prints the change of every benchmark present in both runs and returns the
+    names of those slower than baseline by more than tolerance (a fraction).
+    """
+    base = {benchmark_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        key = benchmark_key(result)
+        if key not in base:
+            continue
+        change = result["mean"] / base[key]["mean"] - 1
+        flag = "REGRESSION" if change > tolerance else ""
+        print("%-28s links=%-3d k=%-2d T=%-5d %+8.1f%% %s" % (key + (100 * change, flag)))
+        if change > tolerance:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--links", type=int, nargs="+", default=DEFAULT_LINKS)
+    parser.add_argument("--cardinality", type=int, nargs="+", default=DEFAULT_CARDINALITIES)
+    parser.add_argument("--T", type=int, nargs="+", default=DEFAULT_TS)
+    parser.add_argument("--only", nargs="+", help="run benchmarks whose name contains one of these")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--imports", action="store_true", help="also report worker import times")
+    args = parser.parse_args()
+
+    current = run(args.links, args.cardinality, args.T, args.only)
+    if args.imports:
+        current["imports"] = import_report()
+    with open(args.out, 'w') as outfile:
+        dump(current, outfile, indent=2)
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = load(infile)
+        if compare(current, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,97 @@
+"""
+Defines the ResultCache, a local content-addressed store of finished Sim runs. A run is
+keyed by a hash of its values (as produced by Sim.get_values, minus mc_sims and the
+settings that don't change results) together with a hash of the source code. Each entry
+keeps the final state of every Process, so a later run with more mc_sims can resume
+from it and only simulate the missing sims.
+"""
+import os
+import shutil
+import numpy as np
+from glob import glob
+from hashlib import sha1
+from json import dump, dumps, load
+
+CACHE_DIR = f"{os.path.dirname(__file__)}/../output/.cache"
+
+# settings that don't change the results of a run
+DISPLAY_ONLY = ("show", "save", "excel", "backend", "checkpoint_every", "profile", "progress")
+
+_code_version = None
+
+
+def code_version():
+    """
+    Returns a digest of every source file of the project.
+    """
+    global _code_version
+    if _code_version is None:
+        digest = sha1()
+        root = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob(root + "/**/*.py", recursive=True)):
+            digest.update(os.path.relpath(path, root).encode())
+            with open(path, 'rb') as infile:
+                digest.update(infile.read())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def environment_digest(environment_dict, cpds=()):
+    """
+    Returns a digest of the exact tables of an environment's models (and of
+    any cpds), which their string forms round.
+    """
+    digest = sha1()
+    for node, model in environment_dict.items():
+        digest.update(repr((node, type(model).__name__, tuple(model.parents), model.domain)).encode())
+        for name in ("_table", "_valid"):
+            if hasattr(model, name):
+                digest.update(np.ascontiguousarray(getattr(model, name)).tobytes())
+    for cpd in cpds:
+        digest.update(str(getattr(cpd, "variable", cpd)).encode())
+        if hasattr(cpd, "values"):
+            digest.update(np.ascontiguousarray(cpd.values, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(values):
+    ignored = DISPLAY_ONLY + ("mc_sims",)
+    described = {key: val for key, val in values.items() if key not in ignored}
+    return sha1(dumps([described, code_version()], sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+
+    def entry(self, key):
+        return f"{self.root}/{key}"
+
+    def lookup(self, key):
+        """
+        Returns (mc_sims, paths of the process states) of the cached run, or None.
+        """
+        meta_path = self.entry(key) + "/meta.json"
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as infile:
+            meta = load(infile)
+        return meta["mc_sims"], [f"{self.entry(key)}/{name}" for name in meta["states"]]
+
+    def store(self, key, values, state_paths):
+        """
+        Copies the final process states of a run into the cache, replacing any
+        entry with fewer sims.
+        """
+        cached = self.lookup(key)
+        if cached is not None and cached[0] >= values["mc_sims"]:
+            return
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.makedirs(entry)
+        names = [os.path.basename(path) for path in state_paths]
+        for path in state_paths:
+            shutil.copy(path, entry)
+        with open(entry + "/meta.json", 'w') as outfile:
+            dump({"mc_sims": values["mc_sims"], "states": names, "values": values}, outfile)
@@ -12,16 +12,54 @@ import numpy as np
 from util import permutations, Counter
 
 
+def cumulative_table(probs):
+  """
+  Returns the cumulative probabilities of each row of probs, with the last
+  column pinned to exactly 1 so a uniform draw in [0, 1) always lands in a row.
+  """
+  cdf = np.cumsum(probs, axis=-1)
+  cdf[..., -1] = 1
+  return cdf
+
+
 def randomize(rng, iter):
-  new_iter = []
-  num_elements = len(iter)
-  for i in range(num_elements):
-    if i == num_elements - 1:
-      new_iter.append(1-sum(new_iter))
-      break
-    new_iter.append(rng.uniform(0, 1-sum(new_iter)))
-  rng.shuffle(new_iter)
-  return tuple(new_iter)
+  """
+  Returns a distribution over len(iter) outcomes drawn uniformly from the simplex.
+  """
+  return tuple(random_rows(rng, (), len(iter)))
+
+
+def random_rows(rng, shape, width):
+  """
+  Returns an array of shape + (width,) whose rows are distributions drawn
+  uniformly from the simplex (i.e. from a flat Dirichlet) in a single draw.
+  """
+  return rng.dirichlet(np.ones(width), size=shape)
+
+
+def levels(values):
+  """
+  Returns the distinct values, sorted when they can be, else in order of appearance.
+  """
+  unique = tuple(dict.fromkeys(values))
+  try:
+    return tuple(sorted(unique))
+  except TypeError:
+    return unique
+
+
+def level_positions(lvl, positions, values):
+  """
+  Returns the positions in lvl (as returned by levels, with positions
+  mapping each value to its index) of an array of values, -1 where a
+  value isn't in lvl. Numeric levels are sorted, so they are searched.
+  """
+  values = np.asarray(values)
+  keys = np.array(lvl)
+  if keys.dtype.kind in "biuf" and values.dtype.kind in "biuf":
+    i = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+    return np.where(keys[i] == values, i, -1)
+  return np.vectorize(lambda val: positions.get(val, -1), otypes=[int])(values)
 
 
 class RandomModel:
@@ -29,13 +67,26 @@ class RandomModel:
     self._probs = tuple(probs)
     self.domain = tuple(range(len(probs)))
     self.parents = tuple()
+    self._radix = tuple()
+    self._positions = tuple()
+    self._table = np.array(probs, dtype=float) / sum(probs)
+    self._cdf = cumulative_table(self._table)
 
   def model(self, rng, **kwargs):
-    return rng.choice(self.domain, p=self._probs)
+    return int(np.searchsorted(self._cdf, rng.random(), side='right'))
+
+  def model_batch(self, rng, n, **kwargs):
+    """
+    Draws n samples with a single uniform draw.
+    """
+    return np.searchsorted(self._cdf, rng.random(n), side='right')
 
   def randomize(self, rng, rand_prob=1.0):
     return RandomModel(randomize(rng, self._probs))
 
+  def with_table(self, table, cdf=None):
+    return RandomModel(tuple(table))
+
   def prob(self, assignment):
     assert assignment in self.domain
     probs = dict()
@@ -69,6 +120,53 @@ class DiscreteModel:
     self._ps = [np.array(w) / sum(w) for w in weights]
     self.domain = tuple(range(len(list(lookup_table.values())[0])))
 
+    # dense tables indexed by the mixed-radix encoding of the positions of the
+    # parent values among the values each parent takes in the lookup table
+    num_parents = len(self._inputs[0])
+    self._levels = tuple(levels(m[i] for m in self._inputs) for i in range(num_parents))
+    self._positions = tuple({val: i for i, val in enumerate(lvl)} for lvl in self._levels)
+    self._radix = tuple(len(lvl) for lvl in self._levels)
+    self._strides = tuple(int(np.prod(self._radix[i + 1:])) for i in range(num_parents))
+    num_rows = int(np.prod(self._radix))
+    table = np.full((num_rows, output_length), 1 / output_length)
+    self._rows = np.array([sum(pos[v] * stride for v, pos, stride in zip(m, self._positions, self._strides))
+                           for m in self._inputs])
+    self._valid = np.zeros(num_rows, dtype=bool)
+    self._valid[self._rows] = True
+    table[self._rows] = self._ps
+    self._set_table(table)
+
+  def _set_table(self, table, cdf=None):
+    self._table = table
+    self._cdf = cumulative_table(table) if cdf is None else cdf
+    self._flat_cdf = (self._cdf + np.arange(len(table))[:, None]).ravel()
+
+  def encode(self, assignments):
+    """
+    Returns the table row of a parent assignment, or None if the
+    assignment doesn't have a lookup.
+    """
+    row = 0
+    for p, positions, stride in zip(self.parents, self._positions, self._strides):
+      i = positions.get(assignments[p])
+      if i is None:
+        return None
+      row += i * stride
+    return row if self._valid[row] else None
+
+  def encode_batch(self, parent_arrays):
+    rows = 0
+    for p, lvl, positions, stride in zip(self.parents, self._levels, self._positions, self._strides):
+      i = level_positions(lvl, positions, parent_arrays[p])
+      if (i < 0).any():
+        rows = None
+        break
+      rows = rows + i * stride
+    if rows is None or not self._valid[rows].all():
+      raise ValueError(
+          "It looks like an input was provided which doesn't have a lookup.")
+    return rows
+
   def prob(self, assignments, my_assignment=None):
     assignment_domains = dict()
     assignment_probs = dict()
@@ -84,33 +182,48 @@ class DiscreteModel:
     return prob_dist if my_assignment is None else prob_dist
 
   def prob_helper(self, assignments, my_assignment=None, multiplier=1):
-    a = tuple([assignments[p] for p in self.parents])
-    b = None
-    for m, p in zip(self._inputs, self._ps):
-      if a == m:
-        b = dict(zip(self._outputs, p * multiplier))
-    if b == None:
+    row = self.encode(assignments)
+    if row is None:
       raise ValueError(
           "It looks like an input was provided which doesn't have a lookup.")
+    b = dict(zip(self._outputs, self._table[row] * multiplier))
     return b if my_assignment is None else b[my_assignment]
 
   def model(self, rng, **kwargs):
-    a = tuple([kwargs[p] for p in self.parents])
-    b = None
-    for m, p in zip(self._inputs, self._ps):
-      if a == m:
-        b = rng.choice(self._outputs, p=p)
-
-    if b == None:
+    row = self.encode(kwargs)
+    if row is None:
       raise ValueError(
           "It looks like an input was provided which doesn't have a lookup.")
-    return int(b)
+    return int(np.searchsorted(self._cdf[row], rng.random(), side='right'))
+
+  def model_batch(self, rng, n, **parent_arrays):
+    """
+    Draws n samples, one per row of the parent arrays, with a single uniform
+    draw. Row r of the table is shifted into [r, r + 1] so one searchsorted
+    over the flattened table finds every sample at once.
+    """
+    rows = self.encode_batch(parent_arrays)
+    width = len(self._outputs)
+    return np.searchsorted(self._flat_cdf, rows + rng.random(n), side='right') - rows * width
 
   def randomize(self, rng):
-    new_table = dict(self._lookup_table)
-    for input, probs in new_table.items():
-      new_table[input] = randomize(rng, probs)
-    return DiscreteModel(self.parents, new_table)
+    num_rows, width = self._table.shape
+    table = random_rows(rng, num_rows, width)
+    table[~self._valid] = 1 / width
+    return self.with_table(table)
+
+  def with_table(self, table, cdf=None):
+    """
+    Returns a model with the same parents and lookup inputs whose dense table
+    (and, if given, its cumulative table) is replaced, skipping the parsing of
+    the constructor. Its lookup table is only rebuilt if it is pickled.
+    """
+    model = DiscreteModel.__new__(DiscreteModel)
+    model.__dict__.update(self.__dict__)
+    model._ps = list(table[self._rows])
+    model._lookup_table = None
+    model._set_table(table, cdf)
+    return model
 
   def __repr__(self):
     return "DiscreteModel(Parents: {}, Probs: {})".format(self.parents, self._ps)
@@ -120,7 +233,10 @@ class DiscreteModel:
     return self.model(args[0], **kwargs)
 
   def __reduce__(self):
-    return (self.__class__, (self.parents, self._lookup_table))
+    lookup_table = self._lookup_table
+    if lookup_table is None:
+      lookup_table = dict(zip(self._inputs, map(tuple, self._ps)))
+    return (self.__class__, (self.parents, lookup_table))
 
 
 class ActionModel:
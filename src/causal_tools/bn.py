@@ -1,53 +1,145 @@
-from pgmpy.base import DAG
-from pgmpy.models import BayesianNetwork
-from pgmpy.estimators import MaximumLikelihoodEstimator
-from pgmpy.factors.discrete.CPD import TabularCPD
-import networkx as nx
+"""
+Defines the BN class, a causal graph over the nodes of an environment that samples
+from its assignment models and answers graph queries (parents, ancestors,
+d-separation) from a compiled GraphIndex. Only NumPy is needed for that; the pgmpy
+model behind node_entropy and do, and graphviz for draw, are imported on first use.
+"""
+
 import numpy as np
-import pandas as pd
 import math
-import graphviz
 import os
-from itertools import combinations, chain
-from copy import deepcopy
-from re import findall
-import random
+from itertools import combinations
+from graphlib import TopologicalSorter
 from causal_tools.assignment_models import ActionModel, RandomModel, DiscreteModel
 from collections.abc import Iterable
 
+
+class CPDStructure:
+    """
+    The structure (variable and evidence) of a pgmpy TabularCPD without its
+    table, so a BN can be rebuilt where pgmpy isn't imported.
+    """
+
+    def __init__(self, variable, evidence):
+        self.variable = variable
+        self.evidence = tuple(evidence)
+
+    @classmethod
+    def of(cls, cpd):
+        return cls(cpd.variable, cpd.get_evidence())
+
+    def get_evidence(self):
+        return list(self.evidence)
+
+    def __repr__(self):
+        return "<CPDStructure: {}|{}>".format(self.variable, ",".join(self.evidence))
+
+
+class GraphIndex:
+    """
+    A compiled, read-only view of a DAG: integer ids for the nodes, parent and
+    child adjacency arrays, and ancestor/descendant bitsets (Python ints whose
+    bit i is set when node i belongs to the set).
+    """
+
+    def __init__(self, nodes, edges):
+        self.names = list(nodes)
+        self.ids = {node: i for i, node in enumerate(self.names)}
+        parents = [[] for _ in self.names]
+        children = [[] for _ in self.names]
+        for u, v in edges:
+            parents[self.ids[v]].append(self.ids[u])
+            children[self.ids[u]].append(self.ids[v])
+        self.parents = [np.array(p, dtype=int) for p in parents]
+        self.children = [np.array(c, dtype=int) for c in children]
+        order = list(TopologicalSorter(dict(enumerate(parents))).static_order())
+        self.ancestors = [0] * len(self.names)
+        for i in order:
+            for p in parents[i]:
+                self.ancestors[i] |= self.ancestors[p] | (1 << p)
+        self.descendants = [0] * len(self.names)
+        for i in reversed(order):
+            for c in children[i]:
+                self.descendants[i] |= self.descendants[c] | (1 << c)
+        self.parent_sets = [frozenset(self.names[p] for p in ps) for ps in parents]
+        self.d_connected = {}
+
+    def bits(self, nodes):
+        mask = 0
+        for node in nodes:
+            mask |= 1 << self.ids[node]
+        return mask
+
+    def from_bits(self, mask):
+        nodes = set()
+        while mask:
+            low = mask & -mask
+            nodes.add(self.names[low.bit_length() - 1])
+            mask ^= low
+        return nodes
+
+
 class BN:
     def __init__(self, nodes=None, edges=None, data=None, latent_edges=[], set_nodes=[], cpds=[], assignment = None):
-        self.model = BayesianNetwork()
+        self.assignment = assignment
+        self.cpds = list(cpds)
+        self.data = data
+        self._model = None
+        self._sampling_plan = None
+        self._graph_index = None
 
         if len(cpds) > 0 and assignment is not None:
-            self.assignment = assignment
+            # the graph is given by the cpds and their evidence
+            self.nodes = []
+            self.edges = []
             for cpd in cpds:
-                # add the node
-                self.model.add_node(cpd.variable)
-                # add the edges for parents
-                for parent in cpd.get_evidence():
-                    self.model.add_edge(parent, cpd.variable)
-                # add the cpd
-                self.model.add_cpds(cpd)
+                self._add_nodes([cpd.variable] + cpd.get_evidence())
+                self.edges.extend((parent, cpd.variable) for parent in cpd.get_evidence())
             return
-        
-        if nodes is not None:
-            self.model.add_nodes_from(nodes)
-        self.model.add_nodes_from(set_nodes)
-
-        if edges is not None:
-            self.model.add_edges_from(edges)
-        self.model.add_edges_from(latent_edges)
-
-        if data is not None and not data.empty:
-            estimator = MaximumLikelihoodEstimator(self.model, data)
-            self.model.fit(data, estimator)
-        else:
-            for node in self.model.nodes():
-                self.model.add_cpds(TabularCPD(node, 2, [[1], [0]]))
+
+        if assignment is not None and nodes is None:
+            nodes = list(assignment)
+            edges = [(parent, node) for node, model in assignment.items()
+                     for parent in model.parents]
+
+        self.nodes = []
+        self._add_nodes(list(nodes or []) + list(set_nodes))
+        self.edges = list(edges or []) + list(latent_edges)
+        self._add_nodes([node for edge in self.edges for node in edge])
         self.observed_vars = sorted(nodes + set_nodes)
         # self.draw()
-    
+
+    def _add_nodes(self, nodes):
+        self.nodes.extend(node for node in dict.fromkeys(nodes) if node not in self.nodes)
+
+    @property
+    def model(self):
+        """
+        The pgmpy BayesianNetwork of this graph with its cpds (fit to data or
+        defaulted when there are none), built on first use.
+        """
+        if self._model is None:
+            from pgmpy.models import BayesianNetwork
+            from pgmpy.estimators import MaximumLikelihoodEstimator
+            from pgmpy.factors.discrete.CPD import TabularCPD
+            model = BayesianNetwork()
+            model.add_nodes_from(self.nodes)
+            model.add_edges_from(self.edges)
+            if self.cpds:
+                model.add_cpds(*[cpd for cpd in self.cpds if isinstance(cpd, TabularCPD)])
+            elif self.data is not None and not self.data.empty:
+                estimator = MaximumLikelihoodEstimator(model, self.data)
+                model.fit(self.data, estimator)
+            else:
+                for node in model.nodes():
+                    model.add_cpds(TabularCPD(node, 2, [[1], [0]]))
+            self._model = model
+        return self._model
+
+    def __getstate__(self):
+        state = dict(self.__dict__, _model=None)
+        state["cpds"] = [CPDStructure.of(cpd) for cpd in self.cpds]
+        return state
 
     def node_entropy(self, node) -> float:
         cpd = self.model.get_cpds(node)
@@ -62,19 +154,53 @@ class BN:
         return 1
 
     def draw(self):
+        import graphviz
         dot = graphviz.Digraph()
-        for node in self.model.nodes():
+        for node in self.nodes:
             dot.node(node, f"{node}\n{self.node_entropy(node)}")
-        for edge in self.model.edges():
+        for edge in self.edges:
             dot.edge(edge[0], edge[1])
         dot.render(
             f'{os.path.dirname(__file__)}/../../output/causal-model.gv', view=True)
 
+    def get_graph_index(self) -> GraphIndex:
+        """
+        Returns the compiled GraphIndex of the model, rebuilding it only after
+        the edges have changed.
+        """
+        if self._graph_index is None:
+            self._graph_index = GraphIndex(self.nodes, self.edges)
+        return self._graph_index
+
+    def add_edge(self, u, v):
+        if self._model is not None:
+            self._model.add_edge(u, v)
+        self._add_nodes([u, v])
+        if (u, v) not in self.edges:
+            self.edges.append((u, v))
+        self._graph_index = None
+
+    def remove_edge(self, u, v):
+        if self._model is not None:
+            self._model.remove_edge(u, v)
+        self.edges.remove((u, v))
+        self._graph_index = None
+
+    def _node_ids(self, nodes) -> list:
+        if not isinstance(nodes, (list)):
+            nodes = [nodes]
+        index = self.get_graph_index()
+        for node in nodes:
+            if node not in index.ids:
+                raise ValueError(f"Node {node} not in graph")
+        return [index.ids[node] for node in nodes]
+
     def get_edges(self) -> list:
-        nodes = list(combinations(self.model.nodes(), 2))
+        nodes = list(combinations(self.nodes, 2))
+        edge_set = set(self.edges)
         edges = []
         for node_pair in nodes:
-            if self.model.has_edge(node_pair[0], node_pair[1]):
+            if node_pair in edge_set:
                 edges.append(node_pair)
         return edges
 
@@ -82,43 +208,34 @@ class BN:
         """
         Returns the parents of a node or set of nodes.
         """
-        if not isinstance(nodes, (list)):
-            nodes = [nodes]
-        
-        all_nodes = [node for node in self.model.nodes]
-        for node in nodes:
-            if node not in all_nodes:
-                raise ValueError(f"Node {node} not in graph")
-        
+        index = self.get_graph_index()
         parents = set()
-        for node_pair in self.model.edges:
-            if node_pair[1] in nodes:
-                parents.add(node_pair[0])
-
+        for i in self._node_ids(nodes):
+            parents |= index.parent_sets[i]
         return parents
 
     def get_ancestors(self, nodes) -> set:
-        if not isinstance(nodes, (list)):
-            nodes = [nodes]
-
-        all_nodes = [node for node in self.model.nodes]
-        for node in nodes:
-            # print([node.to_tuple() for node in self.model.nodes])
-            if node not in all_nodes:
-                raise ValueError(f"Node {node} not in graph")
-
-        ancestors_list = set()
-        nodes_list = set(nodes)
-        while nodes_list:
-            node = nodes_list.pop()
-            if node not in ancestors_list:
-                nodes_list.update(self.model.predecessors(node))
-            ancestors_list.add(node)
+        """
+        Returns the ancestors of a node or set of nodes, including themselves.
+        """
+        index = self.get_graph_index()
+        mask = 0
+        for i in self._node_ids(nodes):
+            mask |= index.ancestors[i] | (1 << i)
+        return index.from_bits(mask)
 
-        return ancestors_list
+    def get_descendants(self, nodes) -> set:
+        """
+        Returns the descendants of a node or set of nodes, including themselves.
+        """
+        index = self.get_graph_index()
+        mask = 0
+        for i in self._node_ids(nodes):
+            mask |= index.descendants[i] | (1 << i)
+        return index.from_bits(mask)
 
     def get_feat_vars(self, act_var) -> set:
-        return self.model.get_parents(act_var)
+        return sorted(self.get_parents(act_var))
 
     def get_dist_as_dict(self, res) -> dict:
         if isinstance(res, str):
@@ -146,16 +263,53 @@ class BN:
         """
         Is x d-separated from y, conditioned on zs?
         """
-        zs = self._variable_or_iterable_to_set(zs)
-        assert x in self.observed_vars
-        assert y in self.observed_vars
-        assert all([z in self.observed_vars for z in zs])
+        self._node_ids(y)
+        return y not in self.get_d_connected(x, zs)
 
-        graph = nx.Graph()
-        graph.add_nodes_from(self.model.nodes)
-        graph.add_edges_from(self.model.edges)
-        paths = nx.all_simple_paths(graph, x, y)
-        return all(self._check_d_separation(path, zs) for path in paths)
+    def get_d_connected(self, x, zs=None) -> frozenset:
+        """
+        Returns every node d-connected to x given zs (x included, unless x is in
+        zs), found in O(V + E) with the Bayes-ball reachability algorithm.
+        Answers are memoized per (x, zs) until the edges change.
+        """
+        zs = self._variable_or_iterable_to_set(zs)
+        index = self.get_graph_index()
+        key = (x, zs)
+        if key not in index.d_connected:
+            start = self._node_ids(x)[0]
+            self._node_ids(list(zs))
+            observed = index.bits(zs)
+            # nodes with an observed descendant (or observed themselves) open colliders
+            opens = observed
+            for z in zs:
+                opens |= index.ancestors[index.ids[z]]
+            reachable = 0
+            visited_up = visited_down = 0
+            to_visit = [(start, True)]
+            while to_visit:
+                i, up = to_visit.pop()
+                bit = 1 << i
+                if up:
+                    if visited_up & bit:
+                        continue
+                    visited_up |= bit
+                else:
+                    if visited_down & bit:
+                        continue
+                    visited_down |= bit
+                is_observed = observed & bit
+                if not is_observed:
+                    reachable |= bit
+                if up and not is_observed:
+                    to_visit.extend((p, True) for p in index.parents[i].tolist())
+                    to_visit.extend((c, False) for c in index.children[i].tolist())
+                elif not up:
+                    if not is_observed:
+                        to_visit.extend((c, False) for c in index.children[i].tolist())
+                    if opens & bit:
+                        to_visit.extend((p, True) for p in index.parents[i].tolist())
+            index.d_connected[key] = frozenset(index.from_bits(reachable))
+        return index.d_connected[key]
 
     def _variable_or_iterable_to_set(self, x) -> frozenset:
         if x is None:
@@ -170,80 +324,81 @@ class BN:
                 .format(x))
 
         return frozenset(x)
-    
-    def _check_d_separation(self, path, zs=None):
+
+    def get_sampling_plan(self):
         """
-        Check if a path is d-separated by set of variables zs.
+        Compiles (once) the plan used by sample: the nodes of the assignment in
+        topological order, the column indices of each node's parents, each
+        node's model, and a mask of which nodes are ActionModels.
         """
-        zs = self._variable_or_iterable_to_set(zs)
-
-        if len(path) < 3:
-            return False
-
-        for a, b, c in zip(path[:-2], path[1:-1], path[2:]):
-            structure = self._classify_three_structure(a, b, c)
-
-        if structure in ("chain", "fork") and b in zs:
-            return True
-
-        if structure == "collider":
-            descendants = (nx.descendants(self.dag, b) | {b})
-            if not descendants & set(zs):
-                return True
-
-        return False
-    
-    def _classify_three_structure(self, a, b, c):
+        if self._sampling_plan is None:
+            order = list(TopologicalSorter(
+                {node: tuple(model.parents) for node, model in self.assignment.items()}
+            ).static_order())
+            column = {node: j for j, node in enumerate(order)}
+            models = [self.assignment[node] for node in order]
+            parent_index = [np.array([column[p] for p in model.parents], dtype=int)
+                            for model in models]
+            is_action = np.array([isinstance(model, ActionModel) for model in models])
+            self._sampling_plan = (order, parent_index, models, is_action)
+        return self._sampling_plan
+
+    def with_models(self, models):
         """
-        Classify three structure as a chain, fork or collider.
+        Returns a copy of this BN sharing its graph (and compiled sampling plan)
+        whose assignment models are replaced by those given for its nodes.
+        ActionModel nodes of this BN are kept as they are.
         """
-        dag = nx.Graph()
-        dag.add_nodes_from(self.model.nodes)
-        dag.add_edges_from(self.model.edges)
-
-        if dag.has_edge(a, b) and dag.has_edge(b, c):
-            return "chain"
-
-        if dag.has_edge(c, b) and dag.has_edge(b, a):
-            return "chain"
-
-        if dag.has_edge(a, b) and dag.has_edge(c, b):
-            return "collider"
-
-        if dag.has_edge(b, a) and dag.has_edge(b, c):
-            return "fork"
-
-        raise ValueError("Unsure how to classify ({},{},{})".format(a, b, c))
-
-    def sample(self, rng, set_values={}):
+        bn = self.__class__.__new__(self.__class__)
+        bn.__dict__.update(self.__dict__)
+        bn.assignment = dict(self.assignment)
+        for node, model in models.items():
+            if node in bn.assignment and not isinstance(bn.assignment[node], ActionModel):
+                bn.assignment[node] = model
+        if self._sampling_plan is not None:
+            order, parent_index, _, is_action = self._sampling_plan
+            bn._sampling_plan = (order, parent_index, [bn.assignment[node] for node in order], is_action)
+        return bn
+
+    def sample(self, rng, n=None, set_values={}):
         """
         Arguments
         ---------
-        n_samples: int
-            the number of samples to return
+        n: int
+            the number of samples to return, or None for a single sample
 
-        set_values: dict[variable:str, set_value:np.array]
-            the values of the interventional variable
+        set_values: dict[variable:str, set_value:int or np.array]
+            the values of the interventional variables. ActionModel nodes are
+            only sampled through set_values and are left out otherwise.
 
         Returns
         -------
-        samples: pd.DataFrame
+        samples: dict[variable:str, values:np.array] of n values per variable,
+            or dict[variable:str, value:int] if n is None
         """
-        print(f"assigment: {self.assignment}")
-        samples = {}
-        for node in self.model.nodes: # this was cgm
-            c_model = self.assignment[node]
-
-            if isinstance(c_model, ActionModel):
-                # samples[node] = set_values[node]
-                samples[node] = self.model.nodes[node]
+        order, parent_index, models, is_action = self.get_sampling_plan()
+        size = 1 if n is None else n
+        samples = np.zeros((size, len(order)), dtype=int)
+        drawn = np.zeros(len(order), dtype=bool)
+        for j, node in enumerate(order):
+            if node in set_values:
+                samples[:, j] = set_values[node]
+            elif is_action[j]:
+                continue
             else:
+                if not drawn[parent_index[j]].all():
+                    raise ValueError(
+                        f"Node {node} depends on an action node missing from set_values")
+                c_model = models[j]
                 parent_samples = {
-                    parent: samples[parent]
-                    for parent in c_model.parents
+                    parent: samples[:, k]
+                    for parent, k in zip(c_model.parents, parent_index[j])
                 }
-                samples[node] = c_model(rng, **parent_samples)
-        return samples
+                samples[:, j] = c_model.model_batch(rng, size, **parent_samples)
+            drawn[j] = True
+        if n is None:
+            return {node: int(samples[0, j]) for j, node in enumerate(order) if drawn[j]}
+        return {node: samples[:, j] for j, node in enumerate(order) if drawn[j]}
 
     def do(self, node):
         """
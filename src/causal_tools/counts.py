@@ -0,0 +1,293 @@
+"""
+Defines the CountTensor and CountStore classes, which hold the sufficient statistics (counts)
+an agent learns from. Each family (a variable and its parents) is counted in an integer NumPy
+tensor indexed by (own value, parent values), so observing a sample is O(#nodes) and Count
+queries are answered by indexing and summing the tensor. Families whose dense tensor would
+exceed the store's memory budget are counted sparsely instead, by SparseCountTensor.
+"""
+
+import math
+import numpy as np
+from collections.abc import Iterable
+
+# the largest dense count tensor (in bytes) a CountStore allocates for a family
+DENSE_BUDGET = 2**27
+
+
+def is_unassigned(ass):
+  return ass is None or isinstance(ass, Iterable)
+
+
+class CountTensor:
+  def __init__(self, var, parents, domains):
+    self.var = var
+    self.parents = tuple(sorted(parents))
+    self.vars = (var,) + self.parents
+    self.axes = {v: i for i, v in enumerate(self.vars)}
+    self.domains = [tuple(domains[v]) for v in self.vars]
+    self.positions = [{val: i for i, val in enumerate(dom)} for dom in self.domains]
+    self.shape = tuple(len(dom) for dom in self.domains)
+    self.size = math.prod(self.shape)
+    if self.size >= 2**63:
+      raise ValueError("The counts of %s have too many cells to be indexed." % var)
+    self.strides = tuple(math.prod(self.shape[i + 1:]) for i in range(len(self.shape)))
+    # maps value arrays to positions; identity when the domain is range(k)
+    self._lookups = [None if dom == tuple(range(len(dom))) else dom for dom in self.domains]
+    self.allocate()
+
+  def allocate(self):
+    self.counts = np.zeros(self.shape, dtype=np.int64)
+
+  def add(self, sample):
+    self.counts[tuple(pos[sample[v]] for v, pos in zip(self.vars, self.positions))] += 1
+
+  def add_many(self, samples):
+    self.counts += np.bincount(
+        self.offsets_of(samples), minlength=self.size).reshape(self.shape)
+
+  def offsets_of(self, samples):
+    flat = 0
+    for axis, v in enumerate(self.vars):
+      flat = flat + self.index_of(axis, samples[v]) * self.strides[axis]
+    return np.ravel(flat)
+
+  def index_of(self, axis, values):
+    values = np.asarray(values)
+    if self._lookups[axis] is None:
+      return values
+    return np.vectorize(self.positions[axis].__getitem__, otypes=[int])(values)
+
+  def index(self, assignments):
+    """
+    Returns the tuple indexing the counts consistent with a (partial)
+    assignment; unassigned variables are left as full slices.
+    """
+    idx = [slice(None)] * len(self.vars)
+    for var, ass in assignments.items():
+      if is_unassigned(ass):
+        continue
+      idx[self.axes[var]] = self.positions[self.axes[var]][ass]
+    return tuple(idx)
+
+  def at(self, offset):
+    return int(self.counts.flat[offset])
+
+  def marginal(self, idx, keep=()):
+    """
+    Returns the counts at idx (as returned by index) summed over every
+    sliced axis not in keep, with one axis per kept axis, in keep's order.
+    """
+    counts = self.counts[idx]
+    remaining = [axis for axis, i in enumerate(idx) if isinstance(i, slice)]
+    counts = counts.sum(axis=tuple(
+        i for i, axis in enumerate(remaining) if axis not in keep))
+    kept = [axis for axis in remaining if axis in keep]
+    return counts.transpose([kept.index(axis) for axis in keep])
+
+  def observed(self):
+    """
+    Returns the coordinates (one row of axis positions per cell) and
+    counts of every observed cell.
+    """
+    coords = np.argwhere(self.counts)
+    return coords, self.counts[tuple(coords.T)]
+
+  def covers(self, vars):
+    return all(v in self.axes for v in vars)
+
+  def total(self):
+    return int(self.counts.sum())
+
+  def __getitem__(self, count):
+    return int(self.marginal(self.index(dict(count.items()))))
+
+  def __repr__(self):
+    return "<{}: N({}|{}) {}>".format(
+        self.__class__.__name__, self.var, ",".join(self.parents), self.shape)
+
+
+class SparseCountTensor(CountTensor):
+  """
+  A CountTensor holding only its observed cells: a hash map from the flat
+  offset of each cell (the encoding of its value and parent configuration) to
+  its row in growing COO arrays of cell coordinates and counts. Memory grows
+  with the number of distinct observed configurations instead of the number
+  of possible ones. Marginals are summed over the observed cells, and must
+  themselves fit in budget bytes.
+  """
+  def __init__(self, var, parents, domains, budget=DENSE_BUDGET):
+    self.budget = budget
+    super().__init__(var, parents, domains)
+
+  def allocate(self):
+    self.rows = {}
+    self.coords = np.zeros((16, len(self.shape)), dtype=np.int64)
+    self.cells = np.zeros(16, dtype=np.int64)
+    self.used = 0
+
+  def row_of(self, offset, coords):
+    row = self.rows.get(offset)
+    if row is None:
+      if self.used == len(self.cells):
+        self.coords = np.concatenate([self.coords, np.zeros_like(self.coords)])
+        self.cells = np.concatenate([self.cells, np.zeros_like(self.cells)])
+      row = self.rows[offset] = self.used
+      self.coords[row] = coords
+      self.used += 1
+    return row
+
+  def add(self, sample):
+    coords = [pos[sample[v]] for v, pos in zip(self.vars, self.positions)]
+    offset = sum(p * stride for p, stride in zip(coords, self.strides))
+    row = self.row_of(offset, coords)
+    self.cells[row] += 1
+
+  def add_many(self, samples):
+    offsets, counts = np.unique(self.offsets_of(samples), return_counts=True)
+    for offset, count in zip(offsets.tolist(), counts.tolist()):
+      coords = [offset // stride % size for stride, size in zip(self.strides, self.shape)]
+      row = self.row_of(offset, coords)
+      self.cells[row] += count
+
+  def at(self, offset):
+    row = self.rows.get(offset)
+    return 0 if row is None else int(self.cells[row])
+
+  def marginal(self, idx, keep=()):
+    shape = tuple(self.shape[axis] for axis in keep)
+    if 8 * math.prod(shape) > self.budget:
+      raise ValueError("The marginal of %s over %s is too large to hold densely." % (
+          self.var, [self.vars[axis] for axis in keep]))
+    coords, cells = self.coords[:self.used], self.cells[:self.used]
+    match = np.ones(self.used, dtype=bool)
+    for axis, i in enumerate(idx):
+      if not isinstance(i, slice):
+        match &= coords[:, axis] == i
+    if not keep:
+      return cells[match].sum()
+    out = np.zeros(shape, dtype=np.int64)
+    np.add.at(out, tuple(coords[match, axis] for axis in keep), cells[match])
+    return out
+
+  def observed(self):
+    seen = self.cells[:self.used] > 0
+    return self.coords[:self.used][seen], self.cells[:self.used][seen]
+
+  def total(self):
+    return int(self.cells[:self.used].sum())
+
+
+class CountTemplate:
+  """
+  A fixed layout of variables compiled against a CountTensor. Assigning values
+  to the variables produces an integer offset into the counts or, when some are
+  unassigned or the tensor has axes outside the layout, an index of positions
+  and slices whose counts are summed.
+  """
+  def __init__(self, tensor, vars):
+    self.tensor = tensor
+    self.vars = tuple(vars)
+    self.axes = tuple(tensor.axes[v] for v in self.vars)
+    self.positions = tuple(tensor.positions[a] for a in self.axes)
+    self.strides = tuple(tensor.strides[a] for a in self.axes)
+    self.complete = set(self.axes) == set(range(len(tensor.vars)))
+
+  def offset(self, values):
+    """
+    Returns the flat offset of a full assignment of a complete layout,
+    otherwise None.
+    """
+    if not self.complete:
+      return None
+    offset = 0
+    for positions, stride, val in zip(self.positions, self.strides, values):
+      if is_unassigned(val):
+        return None
+      offset += positions[val] * stride
+    return offset
+
+  def index(self, values):
+    idx = [slice(None)] * len(self.tensor.vars)
+    for axis, positions, val in zip(self.axes, self.positions, values):
+      if not is_unassigned(val):
+        idx[axis] = positions[val]
+    return tuple(idx)
+
+  def solve(self, values):
+    offset = self.offset(values)
+    if offset is not None:
+      return self.tensor.at(offset)
+    return int(self.tensor.marginal(self.index(values)))
+
+  def solve_unassigned(self, values, domains={}):
+    """
+    Returns the counts of every combination of the unassigned variables at
+    once, as an array with one axis per unassigned variable (in layout order),
+    restricted to the values in domains where given.
+    """
+    free = [(var, axis, positions) for var, axis, positions, val
+            in zip(self.vars, self.axes, self.positions, values) if is_unassigned(val)]
+    counts = self.tensor.marginal(self.index(values), [axis for _, axis, _ in free])
+    for i, (var, _, positions) in enumerate(free):
+      if var in domains:
+        counts = np.take(counts, [positions[val] for val in domains[var]], axis=i)
+    return counts
+
+
+class CountStore:
+  """
+  The counts of every family in a graph, plus any extra families
+  (e.g. an agent's reward model) registered with add_family. A family
+  whose dense tensor would take more than budget bytes is counted sparsely.
+  """
+  def __init__(self, domains, parents={}, budget=DENSE_BUDGET):
+    self.domains = domains
+    self.budget = budget
+    self.tensors = {var: self.make_tensor(var, ps) for var, ps in parents.items()}
+    self.extra = []
+    self._covering = {}
+
+  def add_family(self, var, parents):
+    for tensor in self.extra:
+      if tensor.var == var and set(tensor.parents) == set(parents):
+        return tensor
+    tensor = self.make_tensor(var, parents)
+    self.extra.append(tensor)
+    self._covering = {}
+    return tensor
+
+  def make_tensor(self, var, parents):
+    size = math.prod(len(self.domains[v]) for v in set(parents) | {var})
+    if 8 * size > self.budget:
+      return SparseCountTensor(var, parents, self.domains, self.budget)
+    return CountTensor(var, parents, self.domains)
+
+  def all_tensors(self):
+    return list(self.tensors.values()) + self.extra
+
+  def observe(self, sample):
+    for tensor in self.all_tensors():
+      tensor.add(sample)
+
+  def observe_many(self, samples):
+    for tensor in self.all_tensors():
+      tensor.add_many(samples)
+
+  def covering(self, vars):
+    """
+    Returns the smallest tensor counting every variable in vars.
+    """
+    key = frozenset(vars)
+    if key not in self._covering:
+      candidates = [t for t in self.all_tensors() if t.covers(key)]
+      if not candidates:
+        raise ValueError("No counted family covers the variables %s" % sorted(key))
+      self._covering[key] = min(candidates, key=lambda t: t.size)
+    return self._covering[key]
+
+  def total(self):
+    tensors = self.all_tensors()
+    return tensors[0].total() if tensors else 0
+
+  def __getitem__(self, count):
+    return self.covering(count.get_vars())[count]
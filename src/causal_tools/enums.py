@@ -1,6 +1,6 @@
 """
-Defines OTP (Observational Transport Policy) and ASR (Action Selection Rule)
-Enums used throughout this project
+Defines OTP (Observational Transport Policy), ASR (Action Selection Rule) and
+Backend (parallel executor) Enums used throughout this project
 """
 
 from enum import Enum
@@ -36,6 +36,23 @@ class ASR(Enum):
     return str(self)
 
 
+class Backend(Enum):
+  PROCESS = 'Process'  # "Process Pool"
+  THREAD = 'Thread'  # "Thread Pool"
+  SERIAL = 'Serial'  # "Serial (no parallelism)"
+
+  def __lt__(self, other):
+    if self.__class__ is other.__class__:
+      return self.value < other.value
+    return NotImplemented
+
+  def __str__(self):
+    return self.value
+
+  def __repr__(self):
+    return str(self)
+
+
 if __name__ == '__main__':
   a = ASR.EG
   b = ASR.EF
@@ -0,0 +1,144 @@
+"""
+Defines the executors a Sim uses to run its Processes. Every executor maps a task over
+a list of arguments (one per worker, e.g. Sim.process_args) and returns the list of
+results in order. The process pool hands results back through shared memory blocks,
+so only small handles are pickled between the workers and the parent.
+"""
+
+import numpy as np
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+from causal_tools.enums import Backend
+from process import Process
+
+
+def run_process(process_args):
+    """
+    Runs a single Process and returns its [cpr, poa] results.
+    """
+    return Process(**process_args).simulate()
+
+
+class SharedArray:
+    """
+    A picklable handle to a copy of an array placed in a shared memory block.
+    The block is owned (and freed) by whichever process collects it.
+    """
+
+    def __init__(self, arr):
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+        self.name = shm.name
+        self.shape = arr.shape
+        self.dtype = arr.dtype.str
+        shm.close()
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+    def collect(self):
+        """
+        Copies the array out of shared memory and frees the block.
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        arr = np.ndarray(self.shape, self.dtype, buffer=shm.buf).copy()
+        shm.close()
+        shm.unlink()
+        return arr
+
+
+def share(obj):
+    """
+    Replaces every numeric array in a (nested) result with a SharedArray handle.
+    """
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        return SharedArray(obj)
+    if isinstance(obj, dict):
+        return {key: share(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(share(val) for val in obj)
+    return obj
+
+
+def collect(obj):
+    """
+    Inverse of share: replaces every SharedArray handle with its array.
+    """
+    if isinstance(obj, SharedArray):
+        return obj.collect()
+    if isinstance(obj, dict):
+        return {key: collect(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(collect(val) for val in obj)
+    return obj
+
+
+def shared_call(fn, arg):
+    return share(fn(arg))
+
+
+def chain_initializers(initializers):
+    """
+    Runs every (initializer, initargs) pair in turn, so a pool can take several.
+    """
+    for initializer, initargs in initializers:
+        initializer(*initargs)
+
+
+class SerialExecutor:
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        self.max_workers = 1
+        if initializer is not None:
+            initializer(*initargs)
+
+    def map(self, fn, args):
+        return [fn(arg) for arg in args]
+
+    def shutdown(self):
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class ThreadExecutor(SerialExecutor):
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        self.pool = ThreadPoolExecutor(max_workers, initializer=initializer, initargs=initargs)
+        self.max_workers = self.pool._max_workers
+
+    def map(self, fn, args):
+        return list(self.pool.map(fn, args))
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class ProcessExecutor(SerialExecutor):
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        self.pool = ProcessPoolExecutor(max_workers, initializer=initializer, initargs=initargs)
+        self.max_workers = self.pool._max_workers
+
+    def map(self, fn, args):
+        return [collect(res) for res in self.pool.map(shared_call, repeat(fn), args)]
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+EXECUTORS = {
+    Backend.PROCESS: ProcessExecutor,
+    Backend.THREAD: ThreadExecutor,
+    Backend.SERIAL: SerialExecutor,
+}
+
+
+def get_executor(backend, max_workers=None, initializer=None, initargs=()):
+    """
+    Returns an executor of the given backend. initializer(*initargs) is run
+    once in every worker before its first task.
+    """
+    if backend not in EXECUTORS:
+        raise ValueError("Backend %s is not supported." % backend)
+    return EXECUTORS[backend](max_workers, initializer, initargs)
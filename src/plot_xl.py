@@ -1,9 +1,13 @@
 """
-Converts an Excel results file to a plot, displays, and saves.
+Converts a saved results directory to a plot, displays, and saves. Curves are
+reduced chunk by chunk from the memory-mapped result store; directories written
+before the store existed fall back to their Excel workbook.
 """
 
+import os
 from pandas import ExcelFile
 import plotly.graph_objs as go
+from results import MANIFEST, TrialStats, load_stats
 
 DIR_NAME = 'DIR_NAME'
 YAXIS_SHORT = 'poa'
@@ -13,16 +17,27 @@ if __name__ == '__main__':
   ex_file = '/%s.xlsx' % YAXIS_SHORT
   yaxis_title = 'Cumulative Pseudo Regret' if YAXIS_SHORT == 'cpr' else 'Probability of Optimal Action'
   figure = []
-  results = ExcelFile(directory + ex_file).parse(sheet_name=None, index_col=0)
+  if os.path.exists(os.path.join(directory, MANIFEST)):
+    results = load_stats(directory, YAXIS_SHORT)
+  else:
+    sheets = ExcelFile(directory + ex_file).parse(sheet_name=None, index_col=0)
+    results = {}
+    for ind_var, df in sheets.items():
+      if list(df.index) == ["mean", "sem"]:
+        results[ind_var] = df
+      else:
+        results[ind_var] = TrialStats.from_rows(df.to_numpy())
   line_dashes = ['solid', 'dot', 'dash', 'dashdot']
   for i, ind_var in enumerate(sorted(results)):
-    df = results[ind_var]
-    x = list(range(len(df.columns)))
+    res = results[ind_var]
+    if isinstance(res, TrialStats):
+      y, sem = res.mean, res.sem()
+    else:
+      y, sem = res.loc["mean"].to_numpy(), res.loc["sem"].to_numpy()
+    x = list(range(len(y)))
     line_name = ind_var
     line_hue = str(int(360 * (i / len(results))))
     line_dash = line_dashes[i] if len(results) <= 4 else 'solid'
-    y = df.mean(axis=0, numeric_only=True)
-    sem = df.sem(axis=0, numeric_only=True)
     y_upper = y + sem
     y_lower = y - sem
     line_color = "hsla(" + line_hue + ",100%,40%,1)"
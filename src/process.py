@@ -4,16 +4,17 @@ run in parallel to get averaged results.
 """
 
 from agent.agent import SoloAgent
-from agent.world import World
-from util import printProgressBar
-from agent.environment import Environment
-import time
-from itertools import cycle
+from agent.world import World, BatchWorld
+import cProfile
+from itertools import cycle, repeat
 from causal_tools.enums import OTP
+from results import allocate, write_rows, grow, save_checkpoint, load_checkpoint
+from profiling import PhaseProfiler, profile_report
+from telemetry import Reporter
 
 
 class Process:
-  def __init__(self, rng, environment, rew_var, is_community, nmc, ind_var, mc_sims, T, ass_perms, num_agents, rand_envs, domains, act_var):
+  def __init__(self, rng, environment, rew_var, is_community, nmc, ind_var, mc_sims, T, ass_perms, num_agents, rand_envs, domains, act_var, batched=False, aggregate=False, checkpoint=None, checkpoint_every=0, profile=False, telemetry=None):
     self.rng = rng
     self.environment = environment
     self.rew_var = rew_var
@@ -27,27 +28,29 @@ class Process:
     self.rand_envs = rand_envs
     self.domains = domains
     self.act_var = act_var
+    self.batched = batched
+    self.aggregate = aggregate
+    self.checkpoint = checkpoint
+    self.checkpoint_every = checkpoint_every
+    self.profile = profile
+    self.telemetry = telemetry
+    self.profiler = PhaseProfiler() if profile else None
 
-  def agent_maker(self, name, environment, assignments, agents):
+  def agent_maker(self, name, environment, assignments):
     otp = assignments.pop("otp")
     if otp == OTP.SOLO:
-      return SoloAgent(self.rng, name, environment, agents, **assignments)
+      return SoloAgent(self.rng, name, environment, **assignments)
     else:
       raise ValueError("OTP type %s is not supported." % otp)
 
   def environment_generator(self):
-    nmc = self.nmc if isinstance(
-        self.nmc, float) else self.rng.uniform(self.nmc[0], self.nmc[1])
-    template = {node: model.randomize(
-        self.rng) for node, model in self.environments[0]._assignment.items()}
-    base = Environment(template, self.rew_var)
-    yield base
-    for _ in range(self.num_agents - 1):
-      randomized = dict(template)
-      for node in base.get_non_act_vars():
-        if self.rng.random() < nmc:
-          randomized[node] = randomized[node].randomize(self.rng)
-      yield Environment(randomized, self.rew_var)
+    """
+    Returns the num_agents randomized environments of one community, built at
+    once from this process's environment.
+    """
+    nmc = self.nmc if not isinstance(
+        self.nmc, (tuple, list)) else self.rng.uniform(self.nmc[0], self.nmc[1])
+    return self.environment.randomize(self.rng, self.num_agents, nmc)
 
   def world_generator(self):
     # These two lines should NOT be necessary. Need to do testing to make sure.
@@ -58,40 +61,124 @@ class Process:
     # assignments = [dict(ass) for _ in range(self.num_agents) for ass in ap]
     if not self.is_community:
       self.rng.shuffle(assignments)
-    agent = SoloAgent(self.rng, "SoloAgent", self.environment, *assignments)
-    return World(agent, self.T)
+    environments = cycle(self.environment_generator()) if self.rand_envs else repeat(self.environment)
+    for ass, environment in zip(assignments, environments):
+      yield World(self.agent_maker("SoloAgent", environment, ass), self.T, self.profiler)
 
   def simulate(self):
-    res = [{}, {}]
-    sim_time = []
-    for i in range(self.mc_sims):
-      sim_start = time.time()
-      world = self.world_generator()
-      time_rem = None if not sim_time else \
-          (sum(sim_time) / len(sim_time)) * \
-          (self.mc_sims - (i + (1 / len(self.ass_perms))))
-      time_rem_str = '?' if time_rem is None else \
-          '%dh %dm   ' % (time_rem // (60 * 60), time_rem // 60 % 60)
-      for k in range(self.T): # these are time steps
+    """
+    Runs the simulation, returning the [cpr, poa] results followed, when
+    profiling, by this process's profile report.
+    """
+    cprofile = cProfile.Profile() if self.profile == "cprofile" else None
+    if cprofile is not None:
+      cprofile.enable()
+    res = self.simulate_batched() if self.batched else self.simulate_worlds()
+    if cprofile is not None:
+      cprofile.disable()
+    if self.profile:
+      res = res + [profile_report(self.profiler, cprofile)]
+    return res
+
+  def simulate_worlds(self):
+    state = self.resume()
+    res, filled, start = ([{}, {}], {}, 0) if state is None else \
+        (state["res"], state["filled"], state["done"])
+    worlds = len(self.ass_perms) * self.num_agents
+    reporter = self.reporter(self.mc_sims * worlds, start * worlds)
+    for i in range(start, self.mc_sims):
+      for world in self.world_generator():
+        for k in range(self.T): # these are time steps
+          world.run_episode(k)
+          if reporter:
+            reporter.add(1)
+        self.update_process_result(res, filled, world)
+      self.save(res, filled, i + 1, self.mc_sims)
+    if reporter:
+      reporter.flush()
+    return res
+
+  def simulate_batched(self):
+    """
+    Runs all mc_sims worlds of each assignment permutation in lockstep,
+    returning one cpr/poa row per world.
+    """
+    state = self.resume()
+    if state is None:
+      res, filled, start = [{}, {}], {}, 0
+      ap = list(self.ass_perms)
+      self.rng.shuffle(ap)
+    else:
+      res, filled, start, ap = state["res"], state["filled"], state["done"], state["order"]
+    reporter = self.reporter(len(ap) * self.mc_sims, start * self.mc_sims)
+    for j in range(start, len(ap)):
+      agent = self.agent_maker("SoloAgent", self.environment, dict(ap[j]))
+      world = BatchWorld(agent, self.T, self.mc_sims, self.profiler)
+      for k in range(self.T):
         world.run_episode(k)
-        # printProgressBar(
-        #     iteration=i*len(self.ass_perms)+1+(k+1)/self.T,
-        #     total=self.mc_sims * len(self.ass_perms),
-        #     suffix=time_rem_str,
-        # )
-        self.update_process_result(res, world)
-      sim_time.append(time.time() - sim_start)
+        if reporter:
+          reporter.add(self.mc_sims)
+      self.update_process_result(res, filled, world)
+      self.save(res, filled, j + 1, len(ap), order=ap)
+    if reporter:
+      reporter.flush()
     return res
 
-  def update_process_result(self, res, world):
-    raw = (world.cpr, world.poa)
-    for i in (0, 1):
-      for data in raw[i]:
-        ind_var = world.agent.get_ind_var_value(self.ind_var)
-        if ind_var not in res[i]:
-          res[i][ind_var] = [data]
-          continue
-        res[i][ind_var].append(data)
+  def reporter(self, worlds, done):
+    """
+    Returns the telemetry Reporter of this process, counting the episodes of
+    the given number of worlds (done of them already finished), or None.
+    """
+    if self.telemetry is None:
+      return None
+    return Reporter(self.telemetry, worlds * self.T, done * self.T)
+
+  def resume(self):
+    """
+    Loads this process's checkpoint, if any, restoring the RNG to where it was
+    when the checkpoint was taken. Returns the saved state or None. The state
+    may come from a finished run with fewer sims, whose result arrays are
+    grown to this run's size.
+    """
+    state = load_checkpoint(self.checkpoint)
+    if state is not None:
+      self.rng.bit_generator.state = state["rng"]
+      for r in state["res"]:
+        for ind_var, acc in r.items():
+          r[ind_var] = grow(acc, self.mc_sims * self.num_agents)
+    return state
+
+  def save(self, res, filled, done, total, **extra):
+    """
+    Checkpoints the partial results after every checkpoint_every completed
+    units (sims, or assignments when batched) and after the last one.
+    """
+    if self.checkpoint is None:
+      return
+    if done != total and (not self.checkpoint_every or done % self.checkpoint_every):
+      return
+    save_checkpoint(self.checkpoint, {
+        "rng": self.rng.bit_generator.state,
+        "res": res,
+        "filled": filled,
+        "done": done,
+        **extra,
+    })
+
+  def update_process_result(self, res, filled, world):
+    """
+    Writes the cpr/poa of a finished world (or every world of a BatchWorld)
+    into the accumulators of its ind_var value, allocating them on first use.
+    """
+    ind_var = world.agent.get_ind_var_value(self.ind_var)
+    if ind_var not in filled:
+      filled[ind_var] = 0
+      accs = allocate(self.mc_sims * self.num_agents, self.T, self.aggregate)
+      for i, acc in enumerate(accs):
+        res[i][ind_var] = acc
+    for i, data in enumerate((world.cpr, world.poa)):
+      write_rows(res[i][ind_var], filled[ind_var], data)
+    filled[ind_var] += len(world.cpr) if isinstance(world, BatchWorld) else 1
     return
 
   def __eq__(self, other):
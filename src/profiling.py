@@ -0,0 +1,125 @@
+"""
+Defines the opt-in profiling of a simulation. A PhaseProfiler accumulates the time a
+World spends in each phase of an episode, per ASR, and each Process reports its
+profiler (plus an optional cProfile of the whole process) alongside its results so
+the Sim can merge them into the run's output directory.
+"""
+
+import os
+import marshal
+import pstats
+from json import dump
+from time import perf_counter
+
+PHASES = ("context", "choose", "post", "observe", "update")
+
+
+class PhaseClock:
+  """
+  Times consecutive phases of one episode: each lap charges the time since
+  the previous lap (or start) to the next phase.
+  """
+  __slots__ = ("times", "calls", "phase", "last")
+
+  def __init__(self, times, calls):
+    self.times = times
+    self.calls = calls
+
+  def start(self):
+    self.phase = 0
+    self.last = perf_counter()
+    return self
+
+  def lap(self):
+    now = perf_counter()
+    self.times[self.phase] += now - self.last
+    self.calls[self.phase] += 1
+    self.phase += 1
+    self.last = now
+
+
+class NoClock:
+  def lap(self):
+    return
+
+
+NO_CLOCK = NoClock()
+
+
+class PhaseProfiler:
+  def __init__(self):
+    self.times = {}
+    self.calls = {}
+    self._clocks = {}
+
+  def start(self, label):
+    if label not in self._clocks:
+      key = str(label)
+      self.times[key] = [0.0] * len(PHASES)
+      self.calls[key] = [0] * len(PHASES)
+      self._clocks[label] = PhaseClock(self.times[key], self.calls[key])
+    return self._clocks[label].start()
+
+  def to_dict(self):
+    return {label: {phase: {
+        "total": self.times[label][i],
+        "calls": self.calls[label][i],
+        "per_call": self.times[label][i] / self.calls[label][i] if self.calls[label][i] else 0,
+    } for i, phase in enumerate(PHASES)} for label in self.times}
+
+
+def profile_report(profiler, cprofile=None):
+  """
+  Returns the picklable profile of a Process: its phase times and, if given,
+  its cProfile stats in the marshalled .prof format.
+  """
+  if cprofile is not None:
+    cprofile.create_stats()
+  return {
+      "phases": profiler.to_dict(),
+      "cprofile": None if cprofile is None else marshal.dumps(cprofile.stats),
+  }
+
+
+def merge_phases(reports):
+  merged = {}
+  for report in reports:
+    for label, phases in report["phases"].items():
+      for phase, timing in phases.items():
+        total = merged.setdefault(label, {}).setdefault(phase, {"total": 0, "calls": 0})
+        total["total"] += timing["total"]
+        total["calls"] += timing["calls"]
+  for phases in merged.values():
+    for timing in phases.values():
+      timing["per_call"] = timing["total"] / timing["calls"] if timing["calls"] else 0
+  return merged
+
+
+def format_phases(phases):
+  lines = ["%-8s" % "ASR" + "".join("%14s" % phase for phase in PHASES) + "  (us/call)"]
+  for label, timings in sorted(phases.items()):
+    lines.append("%-8s" % label + "".join(
+        "%14.2f" % (timings[phase]["per_call"] * 1e6) for phase in PHASES))
+  return "\n".join(lines)
+
+
+def save_profiles(dir_path, reports):
+  """
+  Writes profile.json (per worker and merged phase times) to dir_path and,
+  when the workers ran cProfile, each worker's .prof and their merge.
+  """
+  with open(os.path.join(dir_path, "profile.json"), 'w') as outfile:
+    dump({
+        "phases": list(PHASES),
+        "workers": [report["phases"] for report in reports],
+        "total": merge_phases(reports),
+    }, outfile, indent=2)
+  prof_paths = []
+  for i, report in enumerate(reports):
+    if report["cprofile"] is None:
+      continue
+    prof_paths.append(os.path.join(dir_path, "profile_%d.prof" % i))
+    with open(prof_paths[-1], 'wb') as outfile:
+      outfile.write(report["cprofile"])
+  if prof_paths:
+    pstats.Stats(*prof_paths).dump_stats(os.path.join(dir_path, "profile.prof"))
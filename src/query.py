@@ -3,7 +3,9 @@ Defines Query, Count, Queries, Summation, and Product classes which are used to
 and unknown probability query values and computations.
 """
 
+import numpy as np
 from util import hash_from_dict, only_given_keys, permutations
+from causal_tools.counts import CountStore, CountTensor, CountTemplate
 from collections.abc import MutableSequence, Iterable
 from copy import deepcopy, copy
 
@@ -16,11 +18,44 @@ def is_num(obj):
   return isinstance(obj, (int, float))
 
 
+def is_counts(cpts):
+  if isinstance(cpts, dict):
+    return all(isinstance(cpt, (CountStore, CountTensor)) for cpt in cpts.values())
+  return isinstance(cpts, (CountStore, CountTensor))
+
+
+def term_table(term, cpts, domains=None):
+  """
+  Returns the table of a Summation/Product term over its unassigned
+  variables, along with their (sorted) names.
+  """
+  if is_Q(term):
+    return term.contract(cpts, domains=domains)
+  return np.asarray(term, dtype=float), []
+
+
+def restrictions(query):
+  """
+  Returns the values each restricted (iterably assigned) variable of a
+  Query or Queries ranges over, the way over() enumerates them.
+  """
+  return {var: tuple(ass) for var, ass in query.get_unassigned().items() if ass is not None}
+
+
+def align(table, labels, free):
+  """
+  Adds length-1 axes to a table over the (sorted) labels so it broadcasts
+  against tables over the (sorted) superset free.
+  """
+  return np.reshape(table, [table.shape[labels.index(var)] if var in labels else 1 for var in free])
+
+
 class Query(object):
   def __init__(self, Q, e={}):
     self.Q = self.parse_entry(Q)
     self.e = self.parse_entry(e)
     self.q_e = self.Q_and_e()
+    self._compiled = None
 
   def parse_entry(self, entry):
     if isinstance(entry, dict):
@@ -37,8 +72,36 @@ class Query(object):
   def get_vars(self):
     return set(self.Q_and_e().keys())
 
+  def layout(self):
+    """
+    The fixed order of the query's variables used by its compiled
+    templates: query variables not in the evidence, then the evidence.
+    """
+    return tuple(var for var in self.Q if var not in self.e) + tuple(self.e)
+
+  def values(self):
+    return tuple(self.Q[var] for var in self.Q if var not in self.e) + tuple(self.e.values())
+
+  def compile(self, cpt):
+    """
+    Compiles the query's variable layout into CountTemplates for the
+    joint and the evidence over the count tensor covering the query.
+    Templates are cached until the query is solved against another store.
+    """
+    if self._compiled is None or self._compiled[0] is not cpt:
+      layout = self.layout()
+      tensor = cpt.covering(layout) if isinstance(cpt, CountStore) else cpt
+      self._compiled = (cpt, CountTemplate(tensor, layout), CountTemplate(tensor, tuple(self.e)))
+    return self._compiled
+
   def solve(self, data):
     cpt = data[self.var()] if isinstance(data, dict) else data
+    if isinstance(cpt, (CountStore, CountTensor)):
+      _, joint, evidence = self.compile(cpt)
+      count_e = evidence.solve(tuple(self.e.values()))
+      if count_e == 0:
+        return None
+      return joint.solve(self.values()) / count_e
     count_e = Count(self.e)
     count_e = count_e.solve(cpt)
     if count_e == 0:
@@ -70,10 +133,19 @@ class Query(object):
     return {copy(self).assign(combo) for combo in permutations(domains)}
 
   def unassigned_combos(self, domains):
-    if self.all_assigned():
-      return {self}
-    unassigned = permutations(only_given_keys(domains, self.get_unassigned()))
-    return {copy(self).assign(combo) for combo in unassigned}
+    """
+    Returns every combination of the unassigned variables' domains at once,
+    as a structured array with one field per unassigned variable (sorted),
+    in the order of permutations(domains).
+    """
+    unassigned = sorted(self.get_unassigned())
+    doms = [np.asarray(domains[var]) for var in unassigned]
+    grids = np.meshgrid(*doms, indexing='ij')
+    combos = np.empty(grids[0].size if grids else 1,
+                      dtype=[(var, dom.dtype) for var, dom in zip(unassigned, doms)])
+    for var, grid in zip(unassigned, grids):
+      combos[var] = grid.ravel()
+    return combos
 
   def parse_as_df_query(self):
     str_query = ""
@@ -83,7 +155,32 @@ class Query(object):
     return str_query[:-3]
 
   def solve_unassigned(self, data, domains):
-    return {q: q.solve(data) for q in self.unassigned_combos(domains)}
+    """
+    Solves every combination of the unassigned variables at once, returning
+    an array with one axis per unassigned variable (sorted) and NaN where the
+    evidence was never observed.
+    """
+    cpt = data[self.var()] if isinstance(data, dict) else data
+    _, joint, evidence = self.compile(cpt)
+    counts = joint.solve_unassigned(self.values(), domains)
+    count_e = evidence.solve_unassigned(tuple(self.e.values()), domains)
+    probs = np.divide(counts, count_e, out=np.full(counts.shape, np.nan), where=count_e > 0)
+    return self.sort_unassigned_axes(probs)
+
+  def sort_unassigned_axes(self, arr):
+    free = [var for var, val in zip(self.layout(), self.values())
+            if val is None or isinstance(val, Iterable)]
+    return np.asarray(arr).transpose([free.index(var) for var in sorted(free)])
+
+  def contract(self, cpts, domains=None):
+    """
+    Returns the query's table over its unassigned variables, with their
+    (sorted) names, for use in compiled Summation/Product contractions.
+    Restricted variables only range over their values in domains (by
+    default, the query's own restrictions).
+    """
+    domains = restrictions(self) if domains is None else domains
+    return self.solve_unassigned(cpts, domains), sorted(self.get_unassigned())
 
   def assign(self, var_or_dict, ass=None):
     return self.assign_many(var_or_dict) if ass is None else self.assign_one(var_or_dict, ass)
@@ -124,6 +221,11 @@ class Query(object):
   def __copy__(self):
     return self.__class__(copy(self.Q), copy(self.e))
 
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state["_compiled"] = None
+    return state
+
   def __hash__(self):
     return hash((
         tuple(sorted(self.Q.items())),
@@ -168,8 +270,14 @@ class Count(Query):
           {**self.parse_entry(Q), **self.parse_entry(e)})
 
   def solve(self, cpt):
+    if isinstance(cpt, (CountStore, CountTensor)):
+      return self.compile(cpt)[1].solve(self.values())
     return cpt[self]
 
+  def solve_unassigned(self, cpt, domains):
+    counts = self.compile(cpt)[1].solve_unassigned(self.values(), domains)
+    return self.sort_unassigned_axes(counts)
+
   def issubset(self, other):
     assert isinstance(other, Count)
     return other.Q.items() <= self.Q.items()
@@ -197,7 +305,7 @@ class Queries(MutableSequence):
     a dictionary of their (domain/None) mappings
     """
     unassigned = dict()
-    [unassigned.update(q.get_unassigned()) for q in self]
+    [unassigned.update(q.get_unassigned()) for q in self if is_Q(q)]
     return unassigned
 
   def all_assigned(self):
@@ -302,6 +410,19 @@ class Summation(Queries):
       if isinstance(q, Queries) and not isinstance(q, Product):
         self._list[i] = Summation(q)
 
+  def contract(self, cpts, domains=None):
+    """
+    Returns the pointwise sum of the terms' tables over the union of
+    their unassigned variables.
+    """
+    domains = restrictions(self) if domains is None else domains
+    tables = [term_table(q, cpts, domains) for q in self]
+    free = sorted(set().union(*[labels for _, labels in tables]))
+    summation = np.zeros([1] * len(free))
+    for table, labels in tables:
+      summation = summation + align(table, labels, free)
+    return summation, free
+
   def solve(self, cpts):
     assert self.all_assigned()
     summation = 0
@@ -310,7 +431,7 @@ class Summation(Queries):
         if isinstance(q, (Summation, Product)):
           summation += q.solve(cpts)
         elif isinstance(q, Query):
-          summation += q.solve(cpts[q.var()])
+          summation += q.solve(cpts)
         else:
           summation += q
       except TypeError:
@@ -331,17 +452,46 @@ class Product(Queries):
     for i, q in enumerate(self._list):
       if isinstance(q, Queries) and not isinstance(q, Summation):
         self._list[i] = Product(q)
+    self._paths = {}
+
+  def contract(self, cpts, out=None, domains=None):
+    """
+    Contracts the terms' tables in a single einsum, keeping the variables
+    in out (by default all of them, as when nested in another expression)
+    and summing out the rest. Restricted variables only range over their
+    values in domains (by default, the restrictions of the whole product,
+    as over() assigns them). The contraction path depends only on the
+    layout of the tables, so it is computed once per layout and cached.
+    """
+    domains = restrictions(self) if domains is None else domains
+    tables = [term_table(q, cpts, domains) for q in self]
+    free = sorted(set().union(*[labels for _, labels in tables]))
+    out = free if out is None else list(out)
+    if not tables:
+      return np.asarray(1.0), out
+    ids = {var: i for i, var in enumerate(free)}
+    operands = []
+    for table, labels in tables:
+      operands.extend([table, [ids[var] for var in labels]])
+    operands.append([ids[var] for var in out])
+    key = tuple((table.shape, tuple(labels)) for table, labels in tables) + (tuple(out),)
+    if key not in self._paths:
+      self._paths[key] = np.einsum_path(*operands, optimize='greedy')[0]
+    return np.einsum(*operands, optimize=self._paths[key]), out
 
   def solve(self, cpts):
     if not self.all_assigned():
-      return Summation(self.over()).solve(cpts)
+      if not is_counts(cpts):
+        return Summation(self.over()).solve(cpts)
+      product = float(self.contract(cpts, out=[])[0])
+      return None if np.isnan(product) else product
     product = 1
     for q in self:
       try:
         if isinstance(q, (Summation, Product)):
           product *= q.solve(cpts)
         elif isinstance(q, Query):
-          product *= q.solve(cpts[q.var()])
+          product *= q.solve(cpts)
         else:
           product *= q
       except TypeError:
@@ -0,0 +1,214 @@
+"""
+Defines how a Process accumulates its results. Every ind_var value gets either a
+preallocated (mc_sims, T) array per metric, written once per world, or, in aggregate
+mode, a TrialStats holding the running mean and variance of each trial so memory does
+not grow with the number of sims.
+
+Results are saved as a columnar store: each ind_var's rows are split into .npy chunks
+(or a .npz of its TrialStats) next to a manifest.json that mirrors values.json, so
+they can be memory-mapped and reduced chunk by chunk.
+
+A running Process can also checkpoint its partial results and RNG state with
+save_checkpoint so that an interrupted Sim can be resumed.
+"""
+
+import os
+import pickle
+import numpy as np
+from json import dump, load
+
+METRIC_DTYPES = (np.float32, np.int8) # cpr, poa
+METRICS = ("cpr", "poa")
+MANIFEST = "manifest.json"
+CHUNK_BYTES = 2 ** 26
+
+
+class TrialStats:
+  """
+  Welford's streaming mean and variance of every trial (column) over the
+  rows (worlds) added so far. Partial results are combined with merge.
+  """
+  def __init__(self, T):
+    self.n = 0
+    self.mean = np.zeros(T)
+    self.m2 = np.zeros(T)
+
+  @classmethod
+  def from_rows(cls, rows):
+    rows = np.asarray(rows, dtype=float)
+    stats = cls(rows.shape[-1])
+    stats.add_rows(rows)
+    return stats
+
+  def add(self, row):
+    self.n += 1
+    delta = row - self.mean
+    self.mean += delta / self.n
+    self.m2 += delta * (row - self.mean)
+
+  def add_rows(self, rows):
+    rows = np.asarray(rows, dtype=float)
+    if len(rows) == 0:
+      return
+    other = TrialStats(rows.shape[1])
+    other.n = len(rows)
+    other.mean = rows.mean(axis=0)
+    other.m2 = ((rows - other.mean) ** 2).sum(axis=0)
+    self.merge(other)
+
+  def merge(self, other):
+    """
+    Folds the stats of another set of rows into these (Chan et al.).
+    """
+    n = self.n + other.n
+    if n == 0:
+      return self
+    delta = other.mean - self.mean
+    self.mean = self.mean + delta * (other.n / n)
+    self.m2 = self.m2 + other.m2 + delta ** 2 * (self.n * other.n / n)
+    self.n = n
+    return self
+
+  def var(self):
+    return self.m2 / (self.n - 1) if self.n > 1 else np.full_like(self.m2, np.nan)
+
+  def sem(self):
+    return np.sqrt(self.var() / self.n)
+
+  def __repr__(self):
+    return "<TrialStats: n=%d, T=%d>" % (self.n, len(self.mean))
+
+
+def allocate(n, T, aggregate=False):
+  """
+  Returns the [cpr, poa] accumulators of one ind_var value: (n, T) arrays,
+  or TrialStats in aggregate mode.
+  """
+  if aggregate:
+    return [TrialStats(T) for _ in METRIC_DTYPES]
+  return [np.zeros((n, T), dtype=dtype) for dtype in METRIC_DTYPES]
+
+
+def write_rows(acc, start, rows):
+  """
+  Writes rows (one per world) into an accumulator starting at row start.
+  """
+  if isinstance(acc, TrialStats):
+    rows = np.asarray(rows, dtype=float)
+    if rows.ndim == 1:
+      acc.add(rows)
+    else:
+      acc.add_rows(rows)
+    return
+  rows = np.asarray(rows)
+  if rows.ndim == 1:
+    acc[start] = rows
+  else:
+    acc[start:start + len(rows)] = rows
+
+
+def grow(acc, n):
+  """
+  Pads an array accumulator with empty rows up to n rows.
+  """
+  if isinstance(acc, TrialStats) or len(acc) >= n:
+    return acc
+  return np.concatenate([acc, np.zeros((n - len(acc),) + acc.shape[1:], dtype=acc.dtype)])
+
+
+def combine(parts):
+  """
+  Combines the accumulators of one ind_var across processes.
+  """
+  if isinstance(parts[0], TrialStats):
+    total = TrialStats(len(parts[0].mean))
+    for part in parts:
+      total.merge(part)
+    return total
+  return np.concatenate(parts)
+
+
+def trial_stats(acc):
+  return acc if isinstance(acc, TrialStats) else TrialStats.from_rows(acc)
+
+
+def save_results(dir_path, results, values, chunk_bytes=CHUNK_BYTES):
+  """
+  Writes the combined [cpr, poa] results of a Sim to dir_path as .npy chunks
+  (or .npz stats) plus a manifest describing them.
+  """
+  manifest = {"values": values, "metrics": {}}
+  for metric, res in zip(METRICS, results):
+    entries = []
+    for i, ind_var in enumerate(sorted(res)):
+      acc = res[ind_var]
+      entry = {"ind_var": str(ind_var)}
+      if isinstance(acc, TrialStats):
+        entry["stats"] = "%s_%d.npz" % (metric, i)
+        np.savez(os.path.join(dir_path, entry["stats"]), n=acc.n, mean=acc.mean, m2=acc.m2)
+      else:
+        rows = max(1, chunk_bytes // max(acc[:1].nbytes, 1))
+        entry["dtype"] = acc.dtype.str
+        entry["T"] = acc.shape[1]
+        entry["chunks"] = []
+        for j, start in enumerate(range(0, len(acc), rows)):
+          file_name = "%s_%d_%d.npy" % (metric, i, j)
+          np.save(os.path.join(dir_path, file_name), acc[start:start + rows])
+          entry["chunks"].append({"file": file_name, "rows": len(acc[start:start + rows])})
+      entries.append(entry)
+    manifest["metrics"][metric] = entries
+  with open(os.path.join(dir_path, MANIFEST), 'w') as outfile:
+    dump(manifest, outfile)
+
+
+def load_manifest(dir_path):
+  with open(os.path.join(dir_path, MANIFEST)) as infile:
+    return load(infile)
+
+
+def iter_chunks(dir_path, entry):
+  """
+  Yields the memory-mapped row chunks of a saved ind_var.
+  """
+  for chunk in entry.get("chunks", []):
+    yield np.load(os.path.join(dir_path, chunk["file"]), mmap_mode='r')
+
+
+def load_stats(dir_path, metric):
+  """
+  Returns {ind_var: TrialStats} for a saved metric, reducing the saved rows
+  one chunk at a time.
+  """
+  stats = {}
+  for entry in load_manifest(dir_path)["metrics"][metric]:
+    if "stats" in entry:
+      with np.load(os.path.join(dir_path, entry["stats"])) as data:
+        acc = TrialStats(len(data["mean"]))
+        acc.n, acc.mean, acc.m2 = int(data["n"]), data["mean"], data["m2"]
+    else:
+      acc = TrialStats(entry["T"])
+      for chunk in iter_chunks(dir_path, entry):
+        acc.add_rows(chunk)
+    stats[entry["ind_var"]] = acc
+  return stats
+
+
+def save_checkpoint(path, state):
+  """
+  Pickles a Process's state to path, replacing any previous checkpoint
+  atomically so an interruption never leaves a partial file.
+  """
+  tmp_path = path + ".tmp"
+  with open(tmp_path, 'wb') as outfile:
+    pickle.dump(state, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+  """
+  Returns the state saved at path, or None if there is no checkpoint.
+  """
+  if path is None or not os.path.exists(path):
+    return None
+  with open(path, 'rb') as infile:
+    return pickle.load(infile)
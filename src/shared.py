@@ -0,0 +1,42 @@
+"""
+Defines SharedBlock, a read-only NumPy array placed in shared memory by the parent of a
+run and attached zero-copy by its workers. Unlike the result handles of the executor,
+the parent owns the block for the whole run and frees it with unlink.
+"""
+import numpy as np
+from multiprocessing import shared_memory
+
+# blocks attached by this process, kept open for as long as it runs
+_attached = {}
+
+
+class SharedBlock:
+    def __init__(self, arr):
+        arr = np.ascontiguousarray(arr)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = np.ndarray(arr.shape, arr.dtype, buffer=self._shm.buf)
+        view[...] = arr
+        del view
+        self.name = self._shm.name
+        self.shape = arr.shape
+        self.dtype = arr.dtype.str
+
+    def attach(self):
+        """
+        Returns a read-only array viewing the block, opening it once per process.
+        """
+        if self.name not in _attached:
+            _attached[self.name] = shared_memory.SharedMemory(name=self.name)
+        arr = np.ndarray(self.shape, self.dtype, buffer=_attached[self.name].buf)
+        arr.flags.writeable = False
+        return arr
+
+    def unlink(self):
+        """
+        Frees the block. Only the process that created it may call this.
+        """
+        self._shm.close()
+        self._shm.unlink()
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype}
@@ -7,19 +7,19 @@ from enum import Enum
 import shutil
 from causal_tools.assignment_models import ActionModel, DiscreteModel, RandomModel
 from agent.environment import Environment
-import plotly.graph_objs as go
 import time
 from numpy.random import randint, default_rng
-import multiprocessing as mp
-from pandas import DataFrame, ExcelWriter
-from json import dump
-from causal_tools.enums import OTP, ASR
-from process import Process
+from json import dump, dumps, load, loads
+from causal_tools.enums import OTP, ASR, Backend
+from executor import get_executor, run_process, chain_initializers
+from results import TrialStats, combine, trial_stats, save_results, load_checkpoint
+from cache import ResultCache, cache_key, environment_digest, DISPLAY_ONLY
+from profiling import format_phases, merge_phases, save_profiles
+from telemetry import Telemetry, Monitor
 from itertools import combinations_with_replacement
-from pgmpy.factors.discrete import TabularCPD
 
 class Sim:
-    def __init__(self, environment_dict, otp, tau, asr, T, mc_sims, EG_epsilon=0, EF_rand_trials=0, ED_cooling_rate=0, is_community=False, rand_envs=False, node_mutation_chance=0, show=True, save=False, seed=None, cpds=[]):
+    def __init__(self, environment_dict, otp, tau, asr, T, mc_sims, EG_epsilon=0, EF_rand_trials=0, ED_cooling_rate=0, is_community=False, rand_envs=False, node_mutation_chance=0, show=True, save=False, seed=None, cpds=[], backend=Backend.PROCESS, num_processes=None, batched=False, aggregate=False, excel=False, checkpoint_every=0, profile=False, progress=False):
         asr = tuple(tuple(e) for e in asr) if isinstance(
             asr, combinations_with_replacement) else asr
         self.start_time = time.time()
@@ -32,17 +32,31 @@ class Sim:
         self.ind_var = self.get_ind_var()
         self.T = T
         self.mc_sims = mc_sims
-        self.num_processes = mp.cpu_count()
+        self.backend = backend
+        self.num_processes = os.cpu_count() if num_processes is None else num_processes
         self.seed = randint(0, 2**31 - (1 + self.num_processes)
                             ) if seed is None else seed
+        # a run with a random seed can never be looked up again, so isn't cached
+        self.seeded = seed is not None
         self.ass_perms = self.get_assignment_permutations()
         self.is_community = is_community
+        self.batched = batched
+        if batched and rand_envs:
+            raise ValueError("Randomized environments can't be simulated batched.")
+        self.aggregate = aggregate
         self.show = show
         self.save = save
+        self.excel = excel
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_dir = None
+        self.profile = profile
+        self.profiles = []
+        self.progress = progress
         self.data_cpr = {}
         self.data_poa = {}
-        self.last_episode_cpr = DataFrame()
-        self.last_episode_poa = DataFrame()
+        # pandas DataFrames, created when plotting
+        self.last_episode_cpr = None
+        self.last_episode_poa = None
         self.values = self.get_values(locals())
         self.domains = self.environment.get_domains()
         self.act_var = self.environment.get_act_var()
@@ -82,16 +96,31 @@ class Sim:
         return assignments
 
     def multithreaded_sim(self):
-        jobs = []
-        results = mp.Manager().list([None] * self.num_processes)
-        proc = Process(**self.process_args(0))
-        results[0] = proc.simulate()
-        # for i in range(self.num_processes):
-        #     job = mp.Process(target=self.sim_process, args=(results, i))
-        #     jobs.append(job)
-        #     job.start()
-        # [job.join() for job in jobs]
-        return results
+        all_process_args = [self.process_args(i) for i in range(self.num_processes)]
+        with self.environment.shared():
+            return self.map_tasks(run_process, all_process_args)
+
+    def map_tasks(self, fn, all_args, initializers=()):
+        """
+        Maps fn over all_args on an executor of this Sim's backend, running every
+        (initializer, initargs) pair of initializers once in each worker first.
+        With progress on, every task reports to its own row of shared telemetry
+        counters (args['telemetry'] is the row) and a Monitor prints their progress.
+        """
+        initializers = list(initializers)
+        monitor = None
+        if self.progress:
+            telemetry = Telemetry(len(all_args))
+            monitor = Monitor(telemetry)
+            initializers.append((telemetry.initializer, telemetry.initargs))
+        with get_executor(self.backend, self.num_processes, chain_initializers, (initializers,)) as executor:
+            if monitor is None:
+                return executor.map(fn, all_args)
+            monitor.start()
+            try:
+                return executor.map(fn, all_args)
+            finally:
+                monitor.stop()
 
     def process_args(self, index):
         return {
@@ -108,22 +137,27 @@ class Sim:
             'rand_envs': self.rand_envs,
             'domains': self.domains,
             'act_var': self.act_var,
+            'batched': self.batched,
+            'aggregate': self.aggregate,
+            'checkpoint': None if self.checkpoint_dir is None else
+                f"{self.checkpoint_dir}/process_{index}.pkl",
+            'checkpoint_every': self.checkpoint_every,
+            'profile': self.profile,
+            'telemetry': index if self.progress else None,
         }
 
-    def sim_process(self, results, index):
-        proc = Process(**self.process_args(index))
-        results[index] = proc.simulate()
-
     def combine_results(self, process_results):
+        # with profiling on, each process appends its profile report
+        self.profiles = [pr[2] for pr in process_results if len(pr) > 2]
         results = [{}, {}]
         for pr in process_results:
             for i in range(len(results)):
                 for ind_var, res in pr[i].items():
                     if ind_var not in results[i]:
-                        results[i][ind_var] = res
+                        results[i][ind_var] = [res]
                         continue
-                    results[i][ind_var].extend(res)
-        return results
+                    results[i][ind_var].append(res)
+        return [{ind_var: combine(res) for ind_var, res in r.items()} for r in results]
 
     def get_ind_var(self):
         ind_var = None
@@ -144,6 +178,12 @@ class Sim:
         return permutations
 
     def get_plot(self, results, plot_title, yaxis_title):
+        # plotting and pandas are only needed by the parent, so load them here
+        import plotly.graph_objs as go
+        from pandas import DataFrame
+        if self.last_episode_cpr is None:
+            self.last_episode_cpr = DataFrame()
+            self.last_episode_poa = DataFrame()
         figure = []
         x = list(range(self.T))
         line_dashes = ['solid', 'dot', 'dash', 'dashdot']
@@ -157,15 +197,21 @@ class Sim:
             line_name = str(ind_var)
             line_hue = str(int(360 * (i / len(results))))
             line_dash = line_dashes[i] if len(results) <= 4 else 'solid'
-            df = DataFrame(results[ind_var])
+            stats = trial_stats(results[ind_var])
+            df = DataFrame({"mean": stats.mean, "sem": stats.sem()}).T
+            if isinstance(results[ind_var], TrialStats):
+                # only the per-trial aggregates were kept
+                last_episode = df.iloc[:, -1]
+            else:
+                last_episode = results[ind_var][:, -1]
             if yaxis_title == "Cumulative Pseudo Regret":
-                self.last_episode_cpr.insert(0, line_name, df.iloc[:, -1])
+                self.last_episode_cpr.insert(0, line_name, last_episode)
                 self.data_cpr[ind_var] = df
             else:
-                self.last_episode_poa.insert(0, line_name, df.iloc[:, -1])
+                self.last_episode_poa.insert(0, line_name, last_episode)
                 self.data_poa[ind_var] = df
-            y = df.mean(axis=0, numeric_only=True)
-            sem = df.sem(axis=0, numeric_only=True)
+            y = stats.mean
+            sem = stats.sem()
             y_upper = y + sem
             y_lower = y - sem
             line_color = "hsla(" + line_hue + ",100%,40%,1)"
@@ -234,6 +280,8 @@ class Sim:
             int(elapsed_time % 60)
         )
         print(f'{print_info}{" " * (70 - len(print_info))}')
+        if self.profiles:
+            print(format_phases(merge_phases(self.profiles)))
 
         if self.show:
             cpr_plot.show()
@@ -247,24 +295,93 @@ class Sim:
             cpr_plot.write_html(dir_path + "/cpr.html")
             poa_plot.write_html(dir_path + "/poa.html")
             self.last_episode_cpr.to_csv(dir_path + "/last_episode_cpr.csv")
-            with ExcelWriter(dir_path + '/cpr.xlsx') as writer:  # doctest: +SKIP
-                for ind_var, df in self.data_cpr.items():
-                    sheet_name = str(ind_var) if ind_var else 'Sheet1'
-                    df.to_excel(writer, sheet_name=sheet_name)
-            with ExcelWriter(dir_path + '/poa.xlsx') as writer:  # doctest: +SKIP
-                for ind_var, df in self.data_poa.items():
-                    sheet_name = str(ind_var) if ind_var else 'Sheet1'
-                    df.to_excel(writer, sheet_name=sheet_name)
+            save_results(dir_path, results, self.values)
+            if self.excel:
+                self.save_excel_summary(dir_path)
             with open(dir_path + '/values.json', 'w') as outfile:
                 dump(self.values, outfile)
+            if self.profiles:
+                save_profiles(dir_path, self.profiles)
             self.environment.bn.draw() # this was cgm
 
-    def run(self, desc=None):
+    def save_excel_summary(self, dir_path):
+        """
+        Writes the per-trial mean and SEM of every ind_var to cpr.xlsx/poa.xlsx.
+        """
+        from pandas import ExcelWriter
+        for name, data in (("cpr", self.data_cpr), ("poa", self.data_poa)):
+            with ExcelWriter(dir_path + '/%s.xlsx' % name) as writer:  # doctest: +SKIP
+                for ind_var, df in data.items():
+                    sheet_name = str(ind_var) if ind_var else 'Sheet1'
+                    df.to_excel(writer, sheet_name=sheet_name)
+
+    def run(self, desc=None, resume=False, cache=False):
+        """
+        Runs the simulation and displays/saves its results. With checkpoint_every
+        set, each process checkpoints its progress; resume=True continues from
+        the checkpoints of an interrupted run with the same desc and values.
+        With cache (and an explicit seed), a run with the same values is loaded
+        from the ResultCache and a cached run with fewer mc_sims is extended
+        rather than rerun.
+        """
         if desc:
             print(desc)
         print("seed=%d | N=%d" % (self.seed, self.get_N()))
-        results = self.combine_results(self.multithreaded_sim())
+        cache = cache and self.seeded
+        key = cache_key(self.values) if cache else None
+        cached = ResultCache().lookup(key) if cache else None
+        if cached is not None and cached[0] == self.mc_sims:
+            print("Loaded from cache %s" % key)
+            results = self.combine_results([load_checkpoint(path)["res"] for path in cached[1]])
+        else:
+            self.prepare_checkpoints(desc, resume, cache)
+            if cached is not None and cached[0] < self.mc_sims and not self.batched:
+                # unbatched sims are drawn in order, so the cached ones are a prefix
+                print("Extending %d cached sims per process" % cached[0])
+                self.seed_checkpoints(cached[1])
+            results = self.combine_results(self.multithreaded_sim())
+            if cache:
+                ResultCache().store(key, self.values, self.checkpoint_paths())
         self.display_and_save(results, desc)
+        if self.checkpoint_dir is not None:
+            shutil.rmtree(self.checkpoint_dir)
+        return results
+
+    def checkpoint_paths(self):
+        return [self.process_args(i)['checkpoint'] for i in range(self.num_processes)]
+
+    def seed_checkpoints(self, state_paths):
+        """
+        Starts every process without a checkpoint of its own from the
+        matching cached state.
+        """
+        for path, state_path in zip(self.checkpoint_paths(), state_paths):
+            if not os.path.exists(path):
+                shutil.copy(state_path, path)
+
+    def prepare_checkpoints(self, desc, resume, cache=False):
+        if not (self.checkpoint_every or resume or cache):
+            self.checkpoint_dir = None
+            return
+        file_name = "{}_N{}".format(desc, self.get_N())
+        self.checkpoint_dir = f"{os.path.dirname(__file__)}/../output/.checkpoints/{file_name}"
+        values_path = self.checkpoint_dir + '/values.json'
+        if resume and os.path.exists(values_path):
+            with open(values_path) as infile:
+                saved = load(infile)
+            if self.checkpoint_values(saved) != self.checkpoint_values(self.values):
+                raise ValueError("Checkpoint %s was made with different values." % self.checkpoint_dir)
+            return
+        if os.path.exists(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+        os.makedirs(self.checkpoint_dir)
+        with open(values_path, 'w') as outfile:
+            dump(self.values, outfile)
+
+    @staticmethod
+    def checkpoint_values(values):
+        # settings that don't change the results may differ between runs
+        return loads(dumps({key: val for key, val in values.items() if key not in DISPLAY_ONLY}))
 
     def get_N(self):
         return self.num_processes * self.mc_sims * self.num_agents
@@ -283,11 +400,16 @@ class Sim:
             parsed_env[node] = str(model)
         parsed_env_dicts.append(parsed_env)
         values["environment_dict"] = tuple(parsed_env_dicts)
+        values["environment_digest"] = environment_digest(env, values["cpds"])
         values["seed"] = self.seed
+        values["num_processes"] = self.num_processes
+        values["backend"] = values["backend"].value
+        values["cpds"] = [str(cpd) for cpd in values["cpds"]]
         return values
 
 
 if __name__ == "__main__":
+    from pgmpy.factors.discrete import TabularCPD
     baseline = {
         "Z": RandomModel((0.5, 0.5)),
         "X": ActionModel(("Z"), (0, 1)),
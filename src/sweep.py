@@ -0,0 +1,137 @@
+"""
+Defines the Sweep class, which runs a grid (or list) of agent configurations against one
+Environment in a single Sim-like run. Configurations may vary several of otp, tau, asr,
+epsilon, rand_trials and cooling_rate at once; configurations that differ only in a
+parameter their ASR ignores are run once. Every (configuration, chunk of sims) pair is a
+task on one shared executor, and results are labelled by the full configuration.
+"""
+from itertools import product
+from math import ceil
+from numpy.random import default_rng
+from causal_tools.enums import OTP, ASR
+from executor import run_process
+from results import combine
+from sim import Sim
+
+PARAMS = ("otp", "tau", "asr", "epsilon", "rand_trials", "cooling_rate")
+
+# the environment of this worker's tasks, set by init_worker when its pool starts
+_environment = None
+
+
+def init_worker(environment):
+    global _environment
+    _environment = environment
+
+
+def run_task(process_args):
+    """
+    Runs one (configuration, chunk) task against this worker's environment.
+    """
+    return run_process({**process_args, "environment": _environment})
+
+
+class Sweep(Sim):
+    def __init__(self, environment_dict, T, mc_sims, grid={}, configs=(), otp=OTP.SOLO, tau=0.05, asr=ASR.EG, EG_epsilon=0, EF_rand_trials=0, ED_cooling_rate=0, chunk_sims=None, **kwargs):
+        """
+        Takes the agent configurations to run (see expand) and chunk_sims, the
+        sims per task; every other keyword is passed on to Sim.
+        """
+        if kwargs.get("checkpoint_every"):
+            raise ValueError("Sweeps can't be checkpointed.")
+        super().__init__(environment_dict, otp, tau, asr, T, mc_sims, EG_epsilon,
+                         EF_rand_trials, ED_cooling_rate, **kwargs)
+        self.base = {
+            "otp": otp,
+            "tau": tau,
+            "asr": asr,
+            "epsilon": EG_epsilon,
+            "rand_trials": EF_rand_trials,
+            "cooling_rate": ED_cooling_rate,
+        }
+        self.configs = self.expand(grid, configs)
+        self.ind_var = None
+        self.chunk_sims = ceil(mc_sims / self.num_processes) if chunk_sims is None else chunk_sims
+        self.values["configs"] = [self.get_label(config) for config in self.configs]
+        self.values["chunk_sims"] = self.chunk_sims
+
+    def expand(self, grid, configs):
+        """
+        Returns the deduplicated list of configurations given by the product of
+        the grid's values and by each explicit configuration, all over the base
+        assignment. Parameters the configuration's ASR ignores are dropped.
+        """
+        for param in list(grid) + [p for c in configs for p in c]:
+            if param not in PARAMS:
+                raise ValueError("Sweep parameter %s is not supported." % param)
+        candidates = [dict(self.base, **dict(zip(grid, values)))
+                      for values in product(*grid.values())] if grid else []
+        candidates += [dict(self.base, **config) for config in configs]
+        expanded = {}
+        for config in candidates:
+            pruned = self.get_assignments(
+                config["otp"], config["tau"], config["asr"], config["epsilon"],
+                config["rand_trials"], config["cooling_rate"])
+            expanded.setdefault(self.get_label(pruned), pruned)
+        return list(expanded.values())
+
+    @staticmethod
+    def get_label(config):
+        return ", ".join("%s=%s" % (param, config[param]) for param in PARAMS if param in config)
+
+    def multithreaded_sim(self):
+        tasks = []
+        for i, config in enumerate(self.configs):
+            for j, start in enumerate(range(0, self.mc_sims, self.chunk_sims)):
+                tasks.append(self.task_args(i, j, min(self.chunk_sims, self.mc_sims - start)))
+        for slot, task in enumerate(tasks):
+            task["telemetry"] = slot if self.progress else None
+        with self.environment.shared():
+            # process workers get a snapshot attaching the shared arrays; serial
+            # and thread workers use the environment itself
+            return self.map_tasks(run_task, tasks, [(init_worker, (self.environment,))])
+
+    def task_args(self, config_index, chunk_index, mc_sims):
+        return {
+            'rng': default_rng([self.seed, config_index, chunk_index]),
+            'rew_var': self.rew_var,
+            'is_community': self.is_community,
+            'nmc': self.nmc,
+            'ind_var': None,
+            'mc_sims': mc_sims,
+            'T': self.T,
+            'ass_perms': [self.configs[config_index]],
+            'num_agents': self.num_agents,
+            'rand_envs': self.rand_envs,
+            'domains': self.domains,
+            'act_var': self.act_var,
+            'batched': self.batched,
+            'aggregate': self.aggregate,
+            'profile': self.profile,
+        }
+
+    def combine_results(self, process_results):
+        """
+        Combines the chunks of every configuration, labelling each by its
+        full configuration.
+        """
+        self.profiles = [pr[2] for pr in process_results if len(pr) > 2]
+        chunks = ceil(self.mc_sims / self.chunk_sims)
+        results = [{}, {}]
+        for i, config in enumerate(self.configs):
+            label = self.get_label(config)
+            parts = process_results[i * chunks:(i + 1) * chunks]
+            for k in range(len(results)):
+                results[k][label] = combine([pr[k][""] for pr in parts])
+        return results
+
+    def run(self, desc=None, resume=False, cache=False):
+        if resume or cache:
+            raise ValueError("Sweeps can't be resumed or cached.")
+        return super().run(desc, cache=False)
+
+    def prepare_checkpoints(self, desc, resume, cache=False):
+        return
+
+    def get_N(self):
+        return self.mc_sims * self.num_agents
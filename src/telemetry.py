@@ -0,0 +1,126 @@
+"""
+Defines the live progress telemetry of a Sim. The Sim allocates one row of counters per
+Process in a shared RawArray that every worker inherits when its pool starts. Each
+Process writes its completed episode count to its own row every UPDATE_EVERY episodes,
+with no locks or proxies, and a Monitor thread in the Sim reads the rows to report
+progress, per-worker throughput, ETA and the slowest worker.
+"""
+import time
+import threading
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+from util import printProgressBar
+
+UPDATE_EVERY = 64
+DONE, TOTAL = 0, 1
+
+# this worker's view of the counters, set by init_worker when its pool starts
+_counters = None
+
+
+def init_worker(raw):
+    global _counters
+    _counters = np.frombuffer(raw).reshape(-1, 2)
+
+
+class Telemetry:
+    """
+    The counters of n Processes, passed to their executor as its initializer.
+    """
+
+    def __init__(self, n):
+        self.raw = RawArray('d', 2 * n)
+        self.counters = np.frombuffer(self.raw).reshape(n, 2)
+        self.initializer = init_worker
+        self.initargs = (self.raw,)
+
+
+class Reporter:
+    """
+    The writer a Process uses to publish its progress to its row.
+    """
+
+    def __init__(self, slot, total, done=0, every=UPDATE_EVERY):
+        self.row = _counters[slot]
+        self.every = every
+        self.done = done
+        self.pending = 0
+        self.row[TOTAL] = total
+        self.row[DONE] = done
+
+    def add(self, episodes):
+        self.pending += episodes
+        if self.pending >= self.every:
+            self.flush()
+
+    def flush(self):
+        self.done += self.pending
+        self.pending = 0
+        self.row[DONE] = self.done
+
+
+class Monitor(threading.Thread):
+    """
+    Periodically prints the aggregate progress of the counters, the total
+    episodes/sec, an ETA and the live episodes/sec of every worker slot,
+    marking the slowest unfinished one.
+    """
+
+    def __init__(self, telemetry, interval=1.0):
+        super().__init__(daemon=True)
+        self.counters = telemetry.counters
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.reset(time.time())
+
+    def reset(self, now):
+        self.start_time = self.last_time = now
+        self.last_done = self.counters[:, DONE].copy()
+
+    def rates(self, now):
+        """
+        Returns the episodes/sec of every slot since the previous call.
+        """
+        done = self.counters[:, DONE].copy()
+        rates = (done - self.last_done) / (now - self.last_time)
+        self.last_time, self.last_done = now, done
+        return rates
+
+    def status(self, now):
+        """
+        Returns (episodes done, total episodes, suffix of the progress line),
+        or None before any slot has reported its total.
+        """
+        total = self.counters[:, TOTAL].sum()
+        if total == 0:
+            return None
+        rates = self.rates(now)
+        done = self.last_done.sum()
+        overall = done / (now - self.start_time)
+        running = self.last_done < self.counters[:, TOTAL]
+        eta = (total - done) / overall if overall > 0 else float('inf')
+        slowest = np.flatnonzero(running)[np.argmin(rates[running])] if running.any() else None
+        workers = " ".join(
+            "%d:%s%s" % (slot, "%d" % rate if running[slot] else "done", "*" if slot == slowest else "")
+            for slot, rate in enumerate(rates))
+        suffix = "%d eps/s | ETA %s | per worker %s" % (overall, format_seconds(eta), workers)
+        return done, total, suffix
+
+    def run(self):
+        self.reset(time.time())
+        while not self.stopped.wait(self.interval):
+            status = self.status(time.time())
+            if status is not None:
+                done, total, suffix = status
+                printProgressBar(done, total, suffix=suffix + "   ")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        print()
+
+
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return '?'
+    return '%dh %dm %ds' % (seconds // (60 * 60), seconds // 60 % 60, seconds % 60)
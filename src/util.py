@@ -3,6 +3,7 @@ Defines several helper/utility methods that are used throughout the project
 for doing calculations, converting datatypes between forms, etc.
 """
 
+import numpy as np
 from math import inf, e, log, sqrt
 from collections.abc import Iterable
 
@@ -188,6 +189,62 @@ def only_given_keys(dictionary, keys):
       del res[key]
   return res
 
+class Encoder:
+  """
+  Encodes assignments of a fixed set of variables as dense integers
+  with a mixed radix over their domains. Codes follow the order of
+  permutations(domains): sorted variables, the first changing slowest.
+  Ex:
+  domains={"A": (0, 1), "B": (0, 1, 2)}
+    => {"A": 1, "B": 2} encodes to 1*3 + 2 = 5
+  """
+  def __init__(self, domains, vars):
+    self.vars = sorted(vars)
+    self.domains = [tuple(domains[var]) for var in self.vars]
+    self.positions = [{val: i for i, val in enumerate(dom)} for dom in self.domains]
+    cards = [len(dom) for dom in self.domains]
+    self.strides = [int(np.prod(cards[i + 1:])) for i in range(len(cards))]
+    self.size = int(np.prod(cards))
+    self._values = [np.array(dom) for dom in self.domains]
+    self._is_range = [dom == tuple(range(len(dom))) for dom in self.domains]
+
+  def encode(self, assignment):
+    code = 0
+    for var, positions, stride in zip(self.vars, self.positions, self.strides):
+      code += positions[assignment[var]] * stride
+    return code
+
+  def encode_batch(self, assignments):
+    """
+    Encodes a dictionary of variables to arrays of their values.
+    """
+    codes = 0
+    for var, values, is_range, stride in zip(self.vars, self._values, self._is_range, self.strides):
+      vals = np.asarray(assignments[var])
+      if is_range:
+        positions = vals
+      else:
+        # searchsorted finds places in the sorted values; map them back to domain positions
+        sorter = np.argsort(values)
+        positions = sorter[np.searchsorted(values, vals, sorter=sorter)]
+      codes = codes + positions * stride
+    return codes
+
+  def decode(self, code):
+    assignment = {}
+    for var, dom, stride in zip(self.vars, self.domains, self.strides):
+      assignment[var] = dom[code // stride]
+      code %= stride
+    return assignment
+
+  def values(self, var):
+    """
+    Returns the value of var in every code, as an array.
+    """
+    i = self.vars.index(var)
+    return self._values[i][(np.arange(self.size) // self.strides[i]) % len(self.domains[i])]
+
+
 class Counter(dict):
   def __getitem__(self, idx):
     self.setdefault(idx, 0)
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+from causal_tools.assignment_models import ActionModel, DiscreteModel, RandomModel
+from causal_tools.counts import CountStore, SparseCountTensor
+from agent.agent import SoloAgent
+from agent.environment import Environment
+
+
+def environment():
+    """
+    Z -> X, X -> W, Z, W -> Y: the reward parents are Z and X.
+    """
+    return Environment({
+        "Z": RandomModel((0.3, 0.7)),
+        "X": ActionModel(("Z",), (0, 1)),
+        "W": DiscreteModel(("X",), {(0,): (0.75, 0.25), (1,): (0.1, 0.9)}),
+        "Y": DiscreteModel(("Z", "W"), {(0, 0): (0.8, 0.2), (0, 1): (0.5, 0.5),
+                                        (1, 0): (0.5, 0.5), (1, 1): (0.2, 0.8)}),
+    })
+
+
+def agent(env, budget=None, **kwargs):
+    """
+    A SoloAgent whose counts are held to budget bytes per family, when given.
+    """
+    agent = SoloAgent(np.random.default_rng(0), "SoloAgent", env, **kwargs)
+    if budget is not None:
+        parents = {var: agent.bn.get_parents(var) for var in agent.domains}
+        agent.counts = CountStore(agent.domains, parents, budget)
+        agent.rew_counts = agent.counts.add_family(agent.rew_var, agent.rew_parents)
+    return agent
+
+
+def observe_samples(agents, env, n=500):
+    rng = np.random.default_rng(1)
+    pre = env.pre.sample(rng, n)
+    samples = env.post.sample(rng, n, {**pre, "X": rng.integers(2, size=n)})
+    for a in agents:
+        a.observe_many(samples)
+
+
+def test_reward_rows_match_reward_cpt():
+    env = environment()
+    dense = agent(env)
+    observe_samples([dense], env)
+    cpt = dense.reward_cpt
+    rows = dense.reward_rows
+    assert len(rows) == 4
+    for config, row in rows.items():
+        evidence = dict(zip(dense.rew_counts.parents, config))
+        column = [cpt.get_value(**{dense.rew_var: rew}, **evidence) for rew in dense.rew_dom]
+        np.testing.assert_allclose(row, column)
+
+
+def test_sparse_reward_model_uses_observed_configurations():
+    env = environment()
+    dense, sparse = agent(env), agent(env, budget=32)
+    assert isinstance(sparse.rew_counts, SparseCountTensor)
+    observe_samples([dense, sparse], env)
+    with pytest.raises(ValueError, match="reward_rows"):
+        sparse.reward_cpt
+    rows, expected = sparse.reward_rows, dense.reward_rows
+    assert rows.keys() == expected.keys()
+    for config in expected:
+        np.testing.assert_allclose(rows[config], expected[config])
+    for z in env.domains["Z"]:
+        np.testing.assert_allclose(sparse.expected_rews({"Z": z}), dense.expected_rews({"Z": z}))
+
+
+def cached_agent(env):
+    """
+    An agent that observed samples and cached its policy in every context.
+    """
+    a = agent(env)
+    observe_samples([a], env)
+    for z in env.domains["Z"]:
+        a.choose_optimal({"Z": z})
+    assert set(a.policy) == {0, 1}
+    return a
+
+
+def test_observe_drops_only_the_observed_policy_key():
+    env = environment()
+    a = cached_agent(env)
+    kept = a.policy[1]
+    a.observe({"Z": 0, "X": 1, "W": 1, "Y": 1})
+    assert set(a.policy) == {1} and a.policy[1] is kept
+
+
+def test_observe_many_drops_only_the_observed_policy_keys():
+    env = environment()
+    a = cached_agent(env)
+    kept = a.policy[0]
+    a.observe_many({"Z": np.array([1, 1]), "X": np.array([0, 1]),
+                    "W": np.array([0, 1]), "Y": np.array([1, 0])})
+    assert set(a.policy) == {0} and a.policy[0] is kept
+
+
+def test_cached_policy_matches_fresh_expected_rewards():
+    env = environment()
+    a = cached_agent(env)
+    a.observe({"Z": 1, "X": 0, "W": 1, "Y": 1})
+    a.choose_optimal({"Z": 1})
+    for z in env.domains["Z"]:
+        expected, best = a.policy[a.policy_enc.encode({"Z": z})]
+        fresh = a.expected_rews({"Z": z})
+        np.testing.assert_array_equal(expected, fresh)
+        assert best == [a.actions[i] for i in np.flatnonzero(fresh == fresh.max())]
+
+
+def test_context_missing_reward_parents_bypasses_cache():
+    env = environment()
+    a = agent(env)
+    observe_samples([a], env)
+    assert a.policy_key({}) is None
+    a.choose_optimal({})
+    assert a.policy == {}
+
+
+def test_tie_breaks_draw_as_rng_choice():
+    env = environment()
+    a = agent(env)
+    a.rng = np.random.default_rng(7)
+    reference = np.random.default_rng(7)
+    for _ in range(50):
+        choice = a.choose_optimal({"Z": 0})
+        assert choice == a.actions[reference.choice(len(a.actions))]
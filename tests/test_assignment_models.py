@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from causal_tools.assignment_models import ActionModel, DiscreteModel, RandomModel
+from agent.environment import Environment
+
+
+def test_discrete_model_looks_up_hashable_values():
+    model = DiscreteModel(("A",), {("x",): (1, 0), ("y",): (0, 1)})
+    rng = np.random.default_rng(0)
+    assert model(rng, A="x") == 0 and model(rng, A="y") == 1
+    values = np.array(["y", "x", "y"])
+    np.testing.assert_array_equal(model.model_batch(rng, 3, A=values), [1, 0, 1])
+    assert model.prob_helper({"A": "y"}) == {0: 0, 1: 1}
+
+
+def test_discrete_model_rejects_values_without_lookup():
+    model = DiscreteModel(("A",), {(0,): (1, 0), (1,): (0, 1)})
+    rng = np.random.default_rng(0)
+    with pytest.raises(ValueError, match="lookup"):
+        model(rng, A=-1)
+    with pytest.raises(ValueError, match="lookup"):
+        model.model_batch(rng, 2, A=np.array([1, -1]))
+    with pytest.raises(ValueError, match="lookup"):
+        model.model_batch(rng, 2, A=np.array([0, 2]))
+
+
+def environment(actions):
+    """
+    Z -> X -> W -> Y, Z -> Y with the action X over the given domain.
+    """
+    return Environment({
+        "Z": RandomModel((0.3, 0.7)),
+        "X": ActionModel(("Z",), actions),
+        "W": DiscreteModel(("X",), {(actions[0],): (0.75, 0.25), (actions[1],): (0.1, 0.9)}),
+        "Y": DiscreteModel(("Z", "W"), {(0, 0): (0.8, 0.2), (0, 1): (0.5, 0.5),
+                                        (1, 0): (0.5, 0.5), (1, 1): (0.2, 0.8)}),
+    })
+
+
+@pytest.mark.parametrize("actions", [(-1, 1), (1, -1), (5, 2)])
+def test_environment_with_non_positional_action_values(actions):
+    env = environment(actions)
+    np.testing.assert_allclose(env.reward_table, environment((0, 1)).reward_table)
+    rng = np.random.default_rng(0)
+    n = 100000
+    pre = env.pre.sample(rng, n)
+    for i, action in enumerate(actions):
+        sample = env.post.sample(rng, n, {**pre, "X": np.full(n, action)})
+        assert sample["W"].mean() == pytest.approx((0.25, 0.9)[i], abs=0.01)
@@ -0,0 +1,29 @@
+import os
+from causal_tools.assignment_models import ActionModel, DiscreteModel, RandomModel
+from causal_tools.enums import ASR, OTP, Backend
+from cache import cache_key
+from sim import Sim
+
+
+def make_sim(p_z=0.5, **kwargs):
+    environment_dict = {
+        "Z": RandomModel((p_z, 1 - p_z)),
+        "X": ActionModel(("Z",), (0, 1)),
+        "Y": DiscreteModel(("Z", "X"), {(0, 0): (0.8, 0.2), (0, 1): (0.5, 0.5),
+                                        (1, 0): (0.5, 0.5), (1, 1): (0.2, 0.8)}),
+    }
+    return Sim(environment_dict=environment_dict, otp=OTP.SOLO, asr=ASR.EG, tau=None, T=10,
+               mc_sims=1, EG_epsilon=0.1, show=False, save=False, seed=1,
+               backend=Backend.SERIAL, **kwargs)
+
+
+def test_key_distinguishes_tables_equal_when_rounded():
+    assert cache_key(make_sim(0.5).values) != cache_key(make_sim(0.5 + 1e-12).values)
+    assert cache_key(make_sim(0.5).values) == cache_key(make_sim(0.5).values)
+
+
+def test_key_uses_resolved_process_count():
+    default = make_sim()
+    assert default.values["num_processes"] == os.cpu_count()
+    assert cache_key(default.values) == cache_key(make_sim(num_processes=os.cpu_count()).values)
+    assert cache_key(default.values) != cache_key(make_sim(num_processes=os.cpu_count() + 1).values)
@@ -0,0 +1,79 @@
+import itertools
+import numpy as np
+import pytest
+from causal_tools.counts import CountStore, CountTensor, SparseCountTensor
+
+# non-range domains, with 3 * 4 * 2 * 3 = 72 cells in the family of Y
+DOMAINS = {"A": (-1, 1, 5), "B": ("x", "y", "z", "w"), "C": (3, 2), "Y": (0, 2, 1)}
+PARENTS = {"A": (), "B": (), "C": (), "Y": ("A", "B", "C")}
+
+
+def stores():
+    # the sparse store holds Y's family sparsely but any marginal of up to 3 axes densely
+    dense = CountStore(DOMAINS, PARENTS, budget=8 * 72)
+    sparse = CountStore(DOMAINS, PARENTS, budget=8 * 36)
+    return dense, sparse
+
+
+def samples(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return {var: np.array(dom)[rng.integers(len(dom), size=n)] for var, dom in DOMAINS.items()}
+
+
+def observe(store, batch, one_at_a_time):
+    if one_at_a_time:
+        for i in range(len(batch["Y"])):
+            store.observe({var: values[i].item() for var, values in batch.items()})
+    else:
+        store.observe_many(batch)
+
+
+def test_make_tensor_picks_backend_by_budget():
+    dense, sparse = stores()
+    assert type(dense.tensors["Y"]) is CountTensor
+    assert type(sparse.tensors["Y"]) is SparseCountTensor
+    assert type(sparse.tensors["A"]) is CountTensor
+
+
+@pytest.mark.parametrize("one_at_a_time", [True, False])
+def test_sparse_counts_match_dense(one_at_a_time):
+    dense, sparse = stores()
+    batch = samples(400)
+    observe(dense, batch, one_at_a_time)
+    observe(sparse, batch, one_at_a_time)
+    d, s = dense.tensors["Y"], sparse.tensors["Y"]
+    # every one of the 72 cells was observed, growing the COO arrays past 16 rows
+    assert s.used == d.size and len(s.cells) >= s.used
+    assert s.total() == d.total() == 400
+    for offset in range(d.size):
+        assert s.at(offset) == d.at(offset)
+
+    # fixed, kept and summed axes, with kept axes out of order
+    for fixed in [{}, {"A": 5}, {"B": "w", "C": 3}, {"A": -1, "B": "y", "C": 2}]:
+        idx = d.index(fixed)
+        free = [axis for axis, i in enumerate(idx) if isinstance(i, slice)]
+        for k in range(min(len(free), 3) + 1):
+            for keep in itertools.permutations(free, k):
+                expected = d.marginal(idx, keep)
+                np.testing.assert_array_equal(s.marginal(s.index(fixed), keep), expected)
+
+
+def test_sparse_counts_match_dense_when_mixing_add_and_add_many():
+    dense, sparse = stores()
+    first, second = samples(30, seed=1), samples(30, seed=2)
+    for store in (dense, sparse):
+        observe(store, first, True)
+        observe(store, second, False)
+    d, s = dense.tensors["Y"], sparse.tensors["Y"]
+    assert [s.at(offset) for offset in range(d.size)] == d.counts.ravel().tolist()
+    coords, cells = s.observed()
+    np.testing.assert_array_equal(d.counts[tuple(coords.T)], cells)
+    assert len(cells) == np.count_nonzero(d.counts)
+
+
+def test_sparse_marginal_over_budget_raises():
+    _, sparse = stores()
+    s = sparse.tensors["Y"]
+    assert 8 * s.size > s.budget
+    with pytest.raises(ValueError, match="too large"):
+        s.marginal(s.index({}), range(4))
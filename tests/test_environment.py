@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from causal_tools.assignment_models import ActionModel, DiscreteModel, RandomModel
+from agent.environment import Environment, optimal_tables
+
+
+def environment(actions):
+    """
+    Z -> X, X -> W, Z, W -> Y with the action X over the given domain.
+    """
+    return Environment({
+        "Z": RandomModel((0.3, 0.7)),
+        "X": ActionModel(("Z",), actions),
+        "W": DiscreteModel(("X",), {(actions[0],): (0.75, 0.25), (actions[1],): (0.1, 0.9)}),
+        "Y": DiscreteModel(("Z", "W"), {(0, 0): (0.8, 0.2), (0, 1): (0.5, 0.5),
+                                        (1, 0): (0.5, 0.5), (1, 1): (0.2, 0.8)}),
+    })
+
+
+@pytest.mark.parametrize("actions", [(1, 2), (2, 1), (3, 0)])
+def test_reward_table_follows_domain_positions(actions):
+    expected = environment((0, 1)).reward_table
+    np.testing.assert_allclose(environment(actions).reward_table, expected)
+
+
+def test_reward_table_matches_sampling_on_unsorted_domain():
+    env = environment((2, 1))
+    rng = np.random.default_rng(0)
+    n = 100000
+    pre = env.pre.sample(rng, n)
+    for action in env.domains["X"]:
+        sample = env.post.sample(rng, n, {**pre, "X": np.full(n, action)})
+        for z in env.domains["Z"]:
+            estimate = sample["Y"][pre["Z"] == z].mean()
+            assert env.expected_reward({"Z": z, "X": action}) == pytest.approx(estimate, abs=0.01)
+
+
+def test_randomized_family_without_mutations_shares_its_base():
+    env = environment((1, 2))
+    family = env.randomize(np.random.default_rng(0), 4, 0)
+    base = family[0]
+    # the family's batched reward tables match an environment built from its models
+    rebuilt = Environment(base._assignment)
+    np.testing.assert_allclose(base.reward_table, rebuilt.reward_table)
+    np.testing.assert_array_equal(base.optimal_action_mask, rebuilt.optimal_action_mask)
+    for member in family[1:]:
+        np.testing.assert_array_equal(member.reward_table, base.reward_table)
+        for node in ("Z", "W", "Y"):
+            np.testing.assert_array_equal(member._assignment[node]._table, base._assignment[node]._table)
+
+
+def test_randomized_rows_stay_normalized():
+    env = environment((1, 2))
+    for member in env.randomize(np.random.default_rng(0), 8, 1):
+        for node in ("Z", "W", "Y"):
+            model = member._assignment[node]
+            np.testing.assert_allclose(model._table.sum(axis=-1), 1)
+            assert (model._table >= 0).all() and (model._cdf[..., -1] == 1).all()
+        np.testing.assert_allclose(member.reward_table, Environment(member._assignment).reward_table)
+
+
+def test_with_models_replaces_only_the_given_models():
+    env = environment((1, 2))
+    w = env._assignment["W"].with_table(np.array([[0.5, 0.5], [0.3, 0.7]]))
+    factors = {"W": (env.compile_factor(w, w._table), ("X", "W"))}
+    reward_table = env.expected_reward_table(dict(env.factors, **factors))
+    replaced = env.with_models({"W": w}, factors, reward_table, *optimal_tables(reward_table))
+    rebuilt = Environment(dict(env._assignment, W=w))
+    np.testing.assert_allclose(replaced.reward_table, rebuilt.reward_table)
+    assert replaced._assignment["Y"] is env._assignment["Y"]
+    rng = np.random.default_rng(0)
+    n = 100000
+    sample = replaced.post.sample(rng, n, {**replaced.pre.sample(rng, n), "X": np.full(n, 2)})
+    assert sample["W"].mean() == pytest.approx(0.7, abs=0.01)
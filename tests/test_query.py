@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from query import Query, Product, Summation
+from causal_tools.counts import CountStore
+
+DOMAINS = {"X": (0, 1), "Y": (0, 1), "Z": (0, 1, 2)}
+
+
+@pytest.fixture
+def store():
+    rng = np.random.default_rng(0)
+    store = CountStore(DOMAINS, {"X": ("Z",), "Y": ("X", "Z"), "Z": ()})
+    store.observe_many({var: rng.integers(len(dom), size=300) for var, dom in DOMAINS.items()})
+    return store
+
+
+@pytest.mark.parametrize("restricted", [(0, 1), (2,), (2, 0)])
+def test_restricted_product_matches_symbolic_path(store, restricted):
+    product = Product([Query({"Y": 1}, {"X": 1, "Z": restricted}), Query({"Z": restricted})])
+    symbolic = Summation(product.over()).solve(store)
+    assert product.solve(store) == pytest.approx(symbolic)
+
+
+def test_unrestricted_product_matches_symbolic_path(store):
+    product = Product([Query({"Y": 1}, {"X": 1, "Z": None}), Query({"Z": None})])
+    symbolic = Summation(Product([Query({"Y": 1}, {"X": 1, "Z": z}), Query({"Z": z})])
+                         for z in DOMAINS["Z"]).solve(store)
+    assert product.solve(store) == pytest.approx(symbolic)
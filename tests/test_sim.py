@@ -0,0 +1,17 @@
+import pytest
+from causal_tools.assignment_models import ActionModel, DiscreteModel, RandomModel
+from causal_tools.enums import ASR, OTP, Backend
+from sim import Sim
+
+
+def test_batched_randomized_environments_are_rejected_up_front():
+    environment_dict = {
+        "Z": RandomModel((0.5, 0.5)),
+        "X": ActionModel(("Z",), (0, 1)),
+        "Y": DiscreteModel(("Z", "X"), {(0, 0): (0.8, 0.2), (0, 1): (0.5, 0.5),
+                                        (1, 0): (0.5, 0.5), (1, 1): (0.2, 0.8)}),
+    }
+    with pytest.raises(ValueError, match="batched"):
+        Sim(environment_dict=environment_dict, otp=OTP.SOLO, asr=ASR.EG, tau=None, T=10,
+            mc_sims=1, show=False, save=False, seed=1, backend=Backend.PROCESS,
+            batched=True, rand_envs=True)
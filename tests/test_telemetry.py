@@ -0,0 +1,28 @@
+import numpy as np
+from telemetry import DONE, TOTAL, Monitor, Telemetry
+
+
+def test_monitor_reports_rate_of_every_worker():
+    telemetry = Telemetry(3)
+    telemetry.counters[:, TOTAL] = 100
+    monitor = Monitor(telemetry)
+    monitor.reset(0.0)
+
+    telemetry.counters[:, DONE] = (20, 10, 100)
+    np.testing.assert_allclose(monitor.rates(2.0), (10, 5, 50))
+    telemetry.counters[:, DONE] = (30, 12, 100)
+    np.testing.assert_allclose(monitor.rates(4.0), (5, 1, 0))
+
+
+def test_status_lists_every_slot_and_marks_the_slowest():
+    telemetry = Telemetry(3)
+    monitor = Monitor(telemetry)
+    monitor.reset(0.0)
+    assert monitor.status(1.0) is None
+
+    monitor.reset(0.0)
+    telemetry.counters[:, TOTAL] = 100
+    telemetry.counters[:, DONE] = (40, 10, 100)
+    done, total, suffix = monitor.status(2.0)
+    assert (done, total) == (150, 300)
+    assert "per worker 0:20 1:5* 2:done" in suffix
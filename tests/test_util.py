@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from util import Encoder, permutations
+
+DOMAINS = [
+    {"A": (1, 0), "B": (0, 1, 2)},
+    {"A": (2, 0, 1), "B": ("y", "x")},
+    {"A": (0, 1), "B": (3, 1, 2)},
+]
+
+
+@pytest.mark.parametrize("domains", DOMAINS)
+def test_encode_batch_matches_encode_on_unsorted_domains(domains):
+    encoder = Encoder(domains, list(domains))
+    assignments = permutations(domains)
+    batch = {var: np.array([ass[var] for ass in assignments]) for var in domains}
+    expected = [encoder.encode(ass) for ass in assignments]
+    assert encoder.encode_batch(batch).tolist() == expected
+    assert sorted(expected) == list(range(encoder.size))
+    assert [encoder.decode(code) for code in expected] == assignments
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from causal_tools.assignment_models import ActionModel, DiscreteModel, RandomModel
+from causal_tools.enums import ASR
+from agent.agent import SoloAgent
+from agent.environment import Environment
+from agent.world import World, BatchWorld, Slots
+
+T = 100
+SIMS = 200
+
+
+def confounded_environment():
+    """
+    U -> A -> X and U -> Y: U is a reward parent of the agent but not a
+    parent of the action.
+    """
+    return Environment({
+        "U": RandomModel((0.5, 0.5)),
+        "A": DiscreteModel(("U",), {(0,): (0.8, 0.2), (1,): (0.2, 0.8)}),
+        "X": ActionModel(("A",), (0, 1)),
+        "Y": DiscreteModel(("X", "U"), {(0, 0): (0.2, 0.8), (0, 1): (0.9, 0.1),
+                                        (1, 0): (0.9, 0.1), (1, 1): (0.2, 0.8)}),
+    })
+
+
+def final_stats(cpr, poa):
+    cpr, poa = np.asarray(cpr, dtype=float), np.asarray(poa, dtype=float)
+    return cpr[:, -1].mean(), cpr[:, -1].std() / np.sqrt(len(cpr)), poa[:, -T // 5:].mean()
+
+
+@pytest.mark.parametrize("asr", [ASR.EG, ASR.TS])
+def test_batch_world_matches_world_on_non_parent_reward_parents(asr):
+    env = confounded_environment()
+    rng = np.random.default_rng(0)
+    agent = SoloAgent(rng, "SoloAgent", env, asr=asr, epsilon=0.1)
+    assert agent.rew_parents - {env.act_var} != env.feat_vars
+
+    cpr, poa = [], []
+    for _ in range(SIMS):
+        world = World(SoloAgent(rng, "SoloAgent", env, asr=asr, epsilon=0.1), T)
+        for k in range(T):
+            world.run_episode(k)
+        cpr.append(world.cpr)
+        poa.append(world.poa)
+    batch = BatchWorld(agent, T, SIMS)
+    for k in range(T):
+        batch.run_episode(k)
+
+    cpr_solo, sem_solo, poa_solo = final_stats(cpr, poa)
+    cpr_batch, sem_batch, poa_batch = final_stats(batch.cpr, batch.poa)
+    assert abs(cpr_solo - cpr_batch) < 4 * np.hypot(sem_solo, sem_batch)
+    assert abs(poa_solo - poa_batch) < 0.05
+
+
+@pytest.mark.parametrize("asr", [ASR.EG, ASR.EF, ASR.ED, ASR.TS])
+def test_batch_world_state_by_seen_slots_matches_dense(asr):
+    env = confounded_environment()
+    worlds = []
+    for budget in (None, 0):
+        agent = SoloAgent(np.random.default_rng(3), "SoloAgent", env, asr=asr, epsilon=0.1,
+                          rand_trials=3, cooling_rate=0.9)
+        kwargs = {} if budget is None else {"budget": budget}
+        worlds.append(BatchWorld(agent, T, 50, **kwargs))
+        for k in range(T):
+            worlds[-1].run_episode(k)
+    dense, sparse = worlds
+    assert dense.key_slots.dense and not sparse.key_slots.dense
+    np.testing.assert_array_equal(sparse.cpr, dense.cpr)
+    np.testing.assert_array_equal(sparse.poa, dense.poa)
+    for code, row in sparse.key_slots.rows.items():
+        np.testing.assert_array_equal(sparse.counts[:, row], dense.counts[:, code])
+
+
+def test_agent_exploration_state_holds_only_seen_contexts():
+    env = confounded_environment()
+    for asr, state in ((ASR.EF, "rand_trials_rem"), (ASR.ED, "epsilon")):
+        agent = SoloAgent(np.random.default_rng(0), "SoloAgent", env, asr=asr,
+                          rand_trials=2, cooling_rate=0.5)
+        assert getattr(agent, state) == {}
+        for _ in range(3):
+            agent.choose({"A": 1})
+        assert getattr(agent, state) == {agent.ctx_enc.encode({"A": 1}): (0 if asr == ASR.EF else 0.125)}
+
+
+def test_slots_grow_state_as_codes_are_seen():
+    slots = Slots(10**9, 8, budget=0)
+    state = np.full((2, slots.capacity), 7)
+    codes = np.array([10**8 + 5 * i for i in range(40)] * 2)
+    rows = slots(codes)
+    np.testing.assert_array_equal(rows, np.tile(np.arange(40), 2))
+    state = slots.fit(state, 1)
+    assert state.shape[1] >= 40
+    assert (state[:, :16] == 7).all() and (state[:, 16:] == 1).all()
+    np.testing.assert_array_equal(slots(np.array([10**8 + 5])), [1])